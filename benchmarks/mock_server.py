@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+'''
+Local stand-in for the Typo API implementing /token and /import.
+
+Usage: python -m benchmarks.mock_server --port 8080 --latency-ms 50
+'''
+
+import argparse
+import gzip
+import http.server
+import json
+import socketserver
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def decode_columns(payload):
+    '''
+    Rows of a payload in the columns format
+    '''
+    rows = [{} for _ in range(payload['count'])]
+    for column in payload['columns']:
+        name = column['name']
+        if 'dictionary' in column:
+            dictionary = column['dictionary']
+            values = [dictionary[index] if index is not None else None for index in column['indexes']]
+        else:
+            values = column['values']
+        missing = set(column.get('missing', ()))
+        for index, (row, value) in enumerate(zip(rows, values)):
+            if index not in missing:
+                row[name] = value
+    return rows
+
+
+def decode_import(payload):
+    '''
+    Returns the records of an import payload as (dataset, row) pairs
+    '''
+    if isinstance(payload, list):
+        return [(record['dataset'], record['data']) for record in payload]
+    if payload.get('format') == 'columns':
+        return [(payload['dataset'], row) for row in decode_columns(payload)]
+    return [(payload['dataset'], row) for row in payload['data']]
+
+
+class MockTypoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately. With Nagle's algorithm the body waits for the delayed ACK of the
+    # client, adding about 40 ms to every response on keep-alive connections.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        started = time.perf_counter()
+        server = self.server
+        body = self.read_body()
+
+        if self.path.endswith('/token'):
+            self.respond(200, {'token': server.token})
+            return
+
+        if not self.path.endswith('/import'):
+            self.respond(404, {'message': 'Not found'})
+            return
+
+        if self.headers.get('Authorization') != 'Bearer ' + server.token:
+            self.respond(401, {'message': 'Invalid token'})
+            return
+
+        with server.lock:
+            throttled = server.throttle > 0
+            server.throttle -= 1
+        if throttled:
+            headers = {} if server.retry_after is None else {'Retry-After': str(server.retry_after)}
+            self.respond(429, {'message': 'Too many requests'}, headers)
+            return
+
+        size = len(body)
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'zstd':
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+        records = decode_import(json.loads(body.decode('utf-8')))
+
+        if server.reject is not None:
+            errors = [server.reject(row) for _, row in records]
+            errors = [error for error in errors if error]
+            if errors:
+                self.respond(400, {'message': errors[0]})
+                return
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.records.extend(records)
+            server.requests.append({
+                'records': len(records),
+                'bytes': size,
+                'latency': time.perf_counter() - started
+            })
+
+        self.respond(200, {'message': 'OK'})
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class MockTypoServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''
+    Keeps every imported record and the size and latency of every import request.
+    reject is called with every imported row and returns an error message to reject the request with status 400.
+    The first throttle import requests are answered with 429 and a Retry-After header of retry_after seconds.
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=0, token='mock-token', reject=None, throttle=0, retry_after=None):
+        super().__init__(('127.0.0.1', port), MockTypoHandler)
+        self.latency = latency_ms / 1000
+        self.token = token
+        self.reject = reject
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.records = []
+        self.requests = []
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=int, default=0, help='Time added to every import request')
+    args = parser.parse_args()
+
+    server = MockTypoServer(args.port, args.latency_ms)
+    print('Mock Typo API listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+'''
+End-to-end throughput benchmark.
+
+Runs target-typo in a subprocess for every benchmark, with the input of the synthetic tap and the mock Typo API,
+and reports records/sec, p50/p99 import latency measured by the mock server, and peak RSS of the target.
+
+Usage: python -m benchmarks.run [--benchmarks benchmarks.json] [--output results.json]
+
+A benchmarks file is a JSON list of objects with a name, a tap object with the arguments of generate_messages,
+a config object merged into the target configuration and an optional latency_ms of the mock server.
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_server import MockTypoServer
+from benchmarks.tap_generator import generate_messages
+
+
+DEFAULT_TAP = {
+    'streams': 2,
+    'records': 20000,
+    'width': 20,
+    'depth': 1,
+    'state_every': 1000
+}
+
+DEFAULT_BENCHMARKS = [
+    {'name': 'default', 'config': {}},
+    {'name': 'latency 20ms', 'latency_ms': 20, 'config': {}},
+    {'name': 'latency 20ms, 4 upload workers', 'latency_ms': 20, 'config': {'upload_workers': 4}},
+    {'name': 'latency 20ms, async engine', 'latency_ms': 20, 'config': {'engine': 'async'}},
+    {'name': 'gzip', 'config': {'compression': 'gzip'}},
+    {'name': 'datasets format', 'config': {'payload_format': 'datasets'}},
+    {'name': 'columns format', 'config': {'payload_format': 'columns'}},
+]
+
+
+# Writes the peak RSS of the target to a file at exit. VmHWM belongs to the process image, unlike ru_maxrss, which
+# keeps the peak of the benchmark process the target was forked from.
+TARGET_COMMAND = '''
+import atexit, sys, target_typo
+
+def write_peak_rss(path):
+    try:
+        with open('/proc/self/status') as status:
+            peak = [line.split()[1] for line in status if line.startswith('VmHWM:')]
+    except OSError:
+        return
+    with open(path, 'w') as output:
+        output.write(peak[0] if peak else '')
+
+atexit.register(write_peak_rss, sys.argv.pop())
+target_typo.main()
+'''
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def run_benchmark(benchmark, directory):
+    tap = dict(DEFAULT_TAP, **benchmark.get('tap', {}))
+    input_file = os.path.join(directory, 'input.jsonl')
+    with open(input_file, 'w') as output:
+        for line in generate_messages(**tap):
+            output.write(line + '\n')
+
+    with MockTypoServer(latency_ms=benchmark.get('latency_ms', 0)) as server:
+        config = {
+            'api_key': 'benchmark',
+            'api_secret': 'benchmark',
+            'cluster_api_endpoint': server.url,
+            'repository': 'benchmark',
+            'disable_collection': True,
+            'send_threshold': 200
+        }
+        config.update(benchmark.get('config', {}))
+        config_file = os.path.join(directory, 'config.json')
+        with open(config_file, 'w') as output:
+            json.dump(config, output)
+
+        rss_file = os.path.join(directory, 'rss')
+        with open(input_file) as stdin, open(os.path.join(directory, 'target.log'), 'w') as stderr:
+            started = time.perf_counter()
+            process = subprocess.Popen(
+                [sys.executable, '-c', TARGET_COMMAND, '-c', config_file, rss_file],
+                stdin=stdin, stdout=subprocess.DEVNULL, stderr=stderr)
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - started
+            process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') \
+                else status >> 8
+
+        latencies = [request['latency'] for request in server.requests]
+        records = len(server.records)
+
+    # Both in kilobytes on Linux
+    peak_rss = usage.ru_maxrss
+    if os.path.exists(rss_file):
+        with open(rss_file) as rss_input:
+            peak_rss = int(rss_input.read() or peak_rss)
+
+    return {
+        'name': benchmark['name'],
+        'exit_code': process.returncode,
+        'records': records,
+        'expected_records': tap['records'],
+        'seconds': elapsed,
+        'records_per_second': records / elapsed if elapsed else 0.0,
+        'requests': len(latencies),
+        'bytes_sent': sum(request['bytes'] for request in server.requests),
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_rss_mb': peak_rss / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', help='JSON file with the list of benchmarks to run')
+    parser.add_argument('--output', help='Writes the results to this JSON file')
+    args = parser.parse_args()
+
+    benchmarks = DEFAULT_BENCHMARKS
+    if args.benchmarks:
+        with open(args.benchmarks) as benchmarks_input:
+            benchmarks = json.load(benchmarks_input)
+
+    results = []
+    print('{:<36} {:>10} {:>9} {:>9} {:>9} {:>10} {:>9}'.format(
+        'benchmark', 'records/s', 'requests', 'p50 ms', 'p99 ms', 'MB sent', 'RSS MB'))
+    for benchmark in benchmarks:
+        with tempfile.TemporaryDirectory() as directory:
+            result = run_benchmark(benchmark, directory)
+        results.append(result)
+
+        print('{:<36} {:>10.0f} {:>9} {:>9.1f} {:>9.1f} {:>10.2f} {:>9.1f}{}'.format(
+            result['name'][:36], result['records_per_second'], result['requests'], result['latency_p50_ms'],
+            result['latency_p99_ms'], result['bytes_sent'] / 1024 / 1024, result['peak_rss_mb'],
+            '' if result['exit_code'] == 0 and result['records'] == result['expected_records']
+            else '  FAILED (exit code {}, {} records)'.format(result['exit_code'], result['records'])))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+'''
+Startup time benchmark.
+
+Measures the median wall time of:
+- python: starting the interpreter alone
+- import: importing target_typo
+- empty run: running target-typo on an empty input against the mock Typo API
+
+Usage: python -m benchmarks.startup [--runs 20]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.mock_server import MockTypoServer
+
+
+def median_time(command, runs, stdin=None):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20, help='Number of runs of each measurement')
+    args = parser.parse_args()
+
+    with MockTypoServer() as server, tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, 'config.json')
+        with open(config_file, 'w') as config_output:
+            json.dump({
+                'api_key': 'benchmark',
+                'api_secret': 'benchmark',
+                'cluster_api_endpoint': server.url,
+                'repository': 'benchmark',
+                'disable_collection': True
+            }, config_output)
+
+        results = [
+            ('python', median_time([sys.executable, '-c', 'pass'], args.runs)),
+            ('import', median_time([sys.executable, '-c', 'import target_typo'], args.runs)),
+            ('empty run', median_time(
+                [sys.executable, '-c', 'import target_typo; target_typo.main()', '-c', config_file],
+                args.runs, stdin=subprocess.DEVNULL)),
+        ]
+
+    for name, seconds in results:
+        print('{:<10} {:8.1f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+'''
+Synthetic Singer tap writing SCHEMA, RECORD and STATE messages to stdout.
+
+Usage: python -m benchmarks.tap_generator --streams 2 --records 10000 --width 20 --depth 1 --state-every 1000
+'''
+
+import argparse
+import json
+import random
+import sys
+
+
+def build_schema(width, depth):
+    '''
+    Object schema with width properties per level, nested depth levels deep
+    '''
+    properties = {}
+    for index in range(width):
+        kind = index % 4
+        if depth > 0 and index == width - 1:
+            properties['nested'] = build_schema(max(width // 2, 1), depth - 1)
+        elif kind == 0:
+            properties['int_{}'.format(index)] = {'type': ['integer', 'null']}
+        elif kind == 1:
+            properties['number_{}'.format(index)] = {'type': ['number', 'null']}
+        elif kind == 2:
+            properties['string_{}'.format(index)] = {'type': ['string', 'null'], 'maxLength': 64}
+        else:
+            properties['category_{}'.format(index)] = {'type': ['string', 'null'], 'enum': ['a', 'b', 'c', None]}
+    return {'type': 'object', 'properties': properties}
+
+
+def build_record(schema, rng, record_id):
+    record = {}
+    for name, subschema in schema['properties'].items():
+        if name == 'nested':
+            record[name] = build_record(subschema, rng, record_id)
+        elif name.startswith('int_'):
+            record[name] = record_id
+        elif name.startswith('number_'):
+            record[name] = round(rng.random() * 1000, 3)
+        elif name.startswith('string_'):
+            record[name] = 'value-{}-{}'.format(record_id, rng.randint(0, 1000))
+        else:
+            record[name] = rng.choice(['a', 'b', 'c'])
+    return record
+
+
+def generate_messages(streams=1, records=1000, width=10, depth=0, state_every=100, seed=0):
+    '''
+    Yields Singer messages as JSON lines. Records of the streams are interleaved and a STATE is written every
+    state_every records.
+    '''
+    rng = random.Random(seed)
+    names = ['stream_{}'.format(index) for index in range(streams)]
+    schema = build_schema(width, depth)
+
+    for name in names:
+        yield json.dumps({'type': 'SCHEMA', 'stream': name, 'schema': schema, 'key_properties': ['int_0']})
+
+    for record_id in range(records):
+        stream = names[record_id % streams]
+        yield json.dumps({'type': 'RECORD', 'stream': stream, 'record': build_record(schema, rng, record_id)})
+        if state_every and (record_id + 1) % state_every == 0:
+            yield json.dumps({'type': 'STATE', 'value': {'bookmark': record_id}})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=1, help='Number of interleaved streams')
+    parser.add_argument('--records', type=int, default=1000, help='Total number of records')
+    parser.add_argument('--width', type=int, default=10, help='Number of properties per object')
+    parser.add_argument('--depth', type=int, default=0, help='Levels of nested objects')
+    parser.add_argument('--state-every', type=int, default=100, help='Records between STATE messages, 0 for none')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for line in generate_messages(args.streams, args.records, args.width, args.depth, args.state_every, args.seed):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -22,104 +22,157 @@ import os  # noqa
 import sys
 import json
 import threading
-import http.client
 import numbers
-import urllib
-import pkg_resources
-from jsonschema.exceptions import ValidationError, SchemaError
-from jsonschema.validators import Draft4Validator
 
-from target_typo.constants import TYPE_RECORD, TYPE_SCHEMA, TYPE_STATE
+from target_typo.batch import PAYLOAD_FORMATS
+from target_typo.codec import CODECS
+from target_typo.compression import COMPRESSION_LEVELS, COMPRESSION_METHODS
+from target_typo.constants import ENGINE_ASYNC, ENGINES, TYPE_RECORD, TYPE_SCHEMA, TYPE_STATE
+from target_typo.default_config import DEFAULTS
 from target_typo.logging import log_critical, log_debug, log_info
-from target_typo.typo import TypoTarget
-from target_typo.utils import emit_state, flatten
+from target_typo.utils import get_version
+from target_typo.validation import VALIDATION_MODES
 
 
 def persist_lines(config, messages):
-    schemas = {}
-    validators = {}
+    # jsonschema and requests are only imported once there is input to process, to keep startup fast
+    # pylint: disable=import-outside-toplevel
+    from target_typo.memory import log_memory_report, start_memory_report
+    from target_typo.metrics import NULL_TIMER, STAGE_ENQUEUE, StageTimer, timed_lines
+    from target_typo.processing import TYPE_ERROR, MessageProcessor, ParallelProcessor
+    from target_typo.typo import TypoTarget
+    from target_typo.validation import ValidationSampler
+
     processed_streams = set()
 
+    # Memory allocations are traced from now on, and the peak is logged at exit
+    memory_report = config.get('memory_report', DEFAULTS['memory_report'])
+    if memory_report:
+        start_memory_report()
+
     # Typo Class
     typo = TypoTarget(config)
-    typo.token = typo.request_token()
+    # The token is requested now, to stop early on invalid credentials
+    typo.tokens.get()
+    # Batches spooled by a previous run are sent before any new input
+    typo.resume()
+
+    metrics = typo.metrics
+    timer = NULL_TIMER
+    if metrics is not None:
+        timer = metrics.timer
+        messages = timed_lines(messages, timer)
+
+    # Records validated against the schema of their stream
+    sampler = ValidationSampler(
+        config.get('validation_mode', DEFAULTS['validation_mode']),
+        config.get('validation_n', DEFAULTS['validation_n']),
+        config.get('validation_seed', DEFAULTS['validation_seed'])
+    )
+
+    # Flattened keys are cached and shared by the rows of each stream
+    key_cache_size = config.get('flatten_key_cache_size', DEFAULTS['flatten_key_cache_size'])
+
+    # Decoding, validation and flattening run in a pool of processes when workers is higher than 1
+    workers = config.get('workers', DEFAULTS['workers'])
+    if workers > 1:
+        processor = ParallelProcessor(typo.codec, workers,
+                                      config.get('worker_chunk_size', DEFAULTS['worker_chunk_size']), metrics, sampler,
+                                      key_cache_size)
+        results = processor.results(messages)
+    else:
+        processor = MessageProcessor(typo.codec, timer, sampler, key_cache_size)
+        results = (processor.process(raw_message) for raw_message in messages)
 
-    # Loop over records from stdin
-    for raw_message in messages:
-        try:
-            message = json.loads(raw_message)
-        except json.decoder.JSONDecodeError:
-            log_critical('Unable to parse line: %s', raw_message)
-            sys.exit(1)
+    # In the async engine the input is processed in a reader thread, the records are enqueued by the event loop
+    engine = config.get('engine', DEFAULTS['engine'])
+    enqueue_timer = timer
+    if metrics is not None and engine == ENGINE_ASYNC:
+        enqueue_timer = StageTimer(metrics.stages)
 
-        if 'type' not in message:
-            log_critical('Line is missing required key \'type\': %s', raw_message)
-            sys.exit(1)
+    def handle(result):
+        # Send records that have been waiting for longer than linger_ms or that a STATE has waited for longer than
+        # max_state_delay_ms, and emit the state when due
+        typo.check_linger()
+        typo.check_state_delay()
+        typo.tracker.check()
+        if metrics is not None:
+            metrics.check_report()
 
-        message_type = message['type']
+        if result is None:
+            return
 
-        if message_type == TYPE_RECORD:
-            # Validate message
-            if message['stream'] in validators:
-                try:
-                    validators[message['stream']].validate(message['record'])
-                except ValidationError as err:
-                    log_critical(err)
-                    sys.exit(1)
-                except SchemaError as err:
-                    log_critical('Invalid schema: %s', err)
-                    sys.exit(1)
-
-            # If the message has properties with JSON sub-properties, they will
-            # be flattened like "a": {"b": 1, "c": 2} -> {"a__b": 1, "a__c": 2}
-            flattened_message = flatten(message['record'])
+        message_type = result[0]
 
+        if message_type == TYPE_RECORD:
+            _, stream, flattened_message = result
+            enqueue_timer.start()
             typo.enqueue_to_dataset(
-                dataset=message['stream'],
+                dataset=stream,
                 line=flattened_message
             )
+            enqueue_timer.lap(STAGE_ENQUEUE)
 
             # Adding processed streams
-            processed_streams.add(message['stream'])
+            processed_streams.add(stream)
 
         elif message_type == TYPE_STATE:
-            if 'value' not in message:
-                log_critical('Received a STATE message without value property: %s', message)
-                sys.exit(1)
-
-            if not typo.data_out:
-                emit_state(message['value'])
-            else:
-                typo.set_state(message['value'])
+            typo.set_state(result[1]['value'])
 
         elif message_type == TYPE_SCHEMA:
-            if 'stream' not in message:
-                log_critical('Line is missing required key "stream": %s', raw_message)
-                sys.exit(1)
-
-            stream = message['stream']
+            message = result[1]
 
             # Validate if stream is processed
-            if stream in processed_streams:
+            if message['stream'] in processed_streams:
                 log_critical('Tap error. SCHEMA message should be specified before messages.')
                 sys.exit(1)
 
             # Validate schema
-            try:
-                schemas[stream] = message['schema']
-            except KeyError:
+            if 'schema' not in message:
                 log_critical('SCHEMA message is missing \'schema\' property: %s', message)
                 sys.exit(1)
 
-            validators[stream] = Draft4Validator(message['schema'])
+            typo.set_key_properties(message['stream'], message.get('key_properties'))
+
+        elif message_type == TYPE_ERROR:
+            log_critical(*result[1:])
+            sys.exit(1)
+
+    if engine == ENGINE_ASYNC:
+        from target_typo.engine import run_async
+        run_async(typo, results, handle, config.get('async_concurrency', DEFAULTS['async_concurrency']))
+    else:
+        try:
+            # Loop over records from stdin, in input order
+            for result in results:
+                handle(result)
+        finally:
+            results.close()
+
+    for stream, counters in sorted(processor.counters().items()):
+        if 'validated' in counters:
+            log_info('Stream %s: %s records validated, %s skipped.', stream, counters['validated'],
+                     counters['validation_skipped'])
+        if 'key_cache_hits' in counters:
+            log_debug('Stream %s: flattened key cache hits: %s, misses: %s.', stream, counters['key_cache_hits'],
+                      counters['key_cache_misses'])
+        if metrics is not None:
+            metrics.set_counters(stream, counters)
 
-    if len(typo.data_out) != 0:
-        typo.import_dataset(typo.data_out)
+    typo.flush()
+
+    if memory_report:
+        log_memory_report()
 
 
 def send_usage_stats():
+    # pylint: disable=import-outside-toplevel
+    import http.client
+    import urllib.parse
+
+    conn = None
     try:
-        version = pkg_resources.get_distribution('target-typo').version
+        version = get_version()
         conn = http.client.HTTPConnection('collector.singer.io', timeout=10)
         conn.connect()
         params = {
@@ -134,7 +187,8 @@ def send_usage_stats():
     except Exception:  # pylint: disable=W0703
         log_debug('Collection request failed', exc_info=True)
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 
 def validate_number_value(parameter_name, value, min_value, max_value, validate_int=False):
@@ -172,6 +226,143 @@ def validate_config(config, config_file):
         if not validate_number_value('send_threshold', config['send_threshold'], 0, 200, True):
             return False
 
+    if 'json_codec' in config and config['json_codec'] not in CODECS:
+        log_critical('Configuration file parameter "json_codec" must be one of: %s.', ', '.join(CODECS))
+        return False
+
+    if 'payload_format' in config and config['payload_format'] not in PAYLOAD_FORMATS:
+        log_critical('Configuration file parameter "payload_format" must be one of: %s.', ', '.join(PAYLOAD_FORMATS))
+        return False
+
+    if 'max_batch_bytes' in config:
+        if not validate_number_value('max_batch_bytes', config['max_batch_bytes'], 0, 2 ** 31, True):
+            return False
+
+    for delay_parameter in ('linger_ms', 'max_state_delay_ms'):
+        if delay_parameter in config:
+            if not validate_number_value(delay_parameter, config[delay_parameter], 0, 86400000, True):
+                return False
+
+    if 'upload_workers' in config:
+        if not validate_number_value('upload_workers', config['upload_workers'], 0, 64, True):
+            return False
+
+    if 'upload_queue_size' in config:
+        if not validate_number_value('upload_queue_size', config['upload_queue_size'], 1, 1000, True):
+            return False
+
+    if 'http_pool_size' in config:
+        if not validate_number_value('http_pool_size', config['http_pool_size'], 1, 1000, True):
+            return False
+
+    for timeout_parameter in ('connect_timeout', 'read_timeout'):
+        if timeout_parameter in config:
+            if not validate_number_value(timeout_parameter, config[timeout_parameter], 0, 3600):
+                return False
+
+    for rate_parameter in ('max_requests_per_second', 'max_bytes_per_second'):
+        if rate_parameter in config:
+            if not validate_number_value(rate_parameter, config[rate_parameter], 0, 2 ** 40):
+                return False
+
+    if 'compression' in config and config['compression'] not in COMPRESSION_METHODS:
+        log_critical('Configuration file parameter "compression" must be one of: %s.', ', '.join(COMPRESSION_METHODS))
+        return False
+
+    compression = config.get('compression', DEFAULTS['compression'])
+    if 'compression_level' in config and compression in COMPRESSION_LEVELS:
+        min_level, max_level = COMPRESSION_LEVELS[compression]
+        if not validate_number_value('compression_level', config['compression_level'], min_level, max_level, True):
+            return False
+
+    if 'compression_min_bytes' in config:
+        if not validate_number_value('compression_min_bytes', config['compression_min_bytes'], 0, 2 ** 31, True):
+            return False
+
+    for threshold_parameter in ('min_send_threshold', 'max_send_threshold', 'send_threshold_step'):
+        if threshold_parameter in config:
+            if not validate_number_value(threshold_parameter, config[threshold_parameter], 1, 100000, True):
+                return False
+
+    if config.get('min_send_threshold', DEFAULTS['min_send_threshold']) > \
+            config.get('max_send_threshold', DEFAULTS['max_send_threshold']):
+        log_critical('Configuration file parameter "min_send_threshold" must be lower than or equal to '
+                     '"max_send_threshold".')
+        return False
+
+    if 'target_latency_ms' in config:
+        if not validate_number_value('target_latency_ms', config['target_latency_ms'], 1, 3600000, True):
+            return False
+
+    for token_parameter in ('token_lifetime_s', 'token_refresh_margin_s'):
+        if token_parameter in config:
+            if not validate_number_value(token_parameter, config[token_parameter], 0, 31536000):
+                return False
+
+    if 'metrics_interval_s' in config:
+        if not validate_number_value('metrics_interval_s', config['metrics_interval_s'], 0, 86400):
+            return False
+
+    if 'metrics_file' in config and not isinstance(config['metrics_file'], str):
+        log_critical('Configuration file parameter "metrics_file" must be a file path.')
+        return False
+
+    if 'dead_letter_file' in config and not isinstance(config['dead_letter_file'], str):
+        log_critical('Configuration file parameter "dead_letter_file" must be a file path.')
+        return False
+
+    if 'spool_dir' in config and not isinstance(config['spool_dir'], str):
+        log_critical('Configuration file parameter "spool_dir" must be a directory path.')
+        return False
+
+    if 'workers' in config:
+        if not validate_number_value('workers', config['workers'], 0, 256, True):
+            return False
+
+    if 'worker_chunk_size' in config:
+        if not validate_number_value('worker_chunk_size', config['worker_chunk_size'], 1, 100000, True):
+            return False
+
+    if 'engine' in config and config['engine'] not in ENGINES:
+        log_critical('Configuration file parameter "engine" must be one of: %s.', ', '.join(ENGINES))
+        return False
+
+    if 'async_concurrency' in config:
+        if not validate_number_value('async_concurrency', config['async_concurrency'], 1, 256, True):
+            return False
+
+    if 'state_interval_ms' in config:
+        if not validate_number_value('state_interval_ms', config['state_interval_ms'], 0, 86400000, True):
+            return False
+
+    if 'state_interval_records' in config:
+        if not validate_number_value('state_interval_records', config['state_interval_records'], 0, 10 ** 9, True):
+            return False
+
+    if 'validation_mode' in config and config['validation_mode'] not in VALIDATION_MODES:
+        log_critical('Configuration file parameter "validation_mode" must be one of: %s.', ', '.join(VALIDATION_MODES))
+        return False
+
+    if 'validation_n' in config:
+        if not validate_number_value('validation_n', config['validation_n'], 1, 10 ** 9, True):
+            return False
+
+    if 'validation_seed' in config:
+        if not validate_number_value('validation_seed', config['validation_seed'], 0, 2 ** 32 - 1, True):
+            return False
+
+    if 'flatten_key_cache_size' in config:
+        if not validate_number_value('flatten_key_cache_size', config['flatten_key_cache_size'], 0, 10 ** 7, True):
+            return False
+
+    if 'max_buffered_bytes' in config:
+        if not validate_number_value('max_buffered_bytes', config['max_buffered_bytes'], 0, 2 ** 40, True):
+            return False
+
+    if config.get('deduplicate') and config.get('spool_dir'):
+        log_critical('Configuration file parameter "deduplicate" cannot be used with "spool_dir".')
+        return False
+
     # Output error message is there are missing parameters
     if len(missing_parameters) != 0:
         sep = ','
@@ -204,7 +395,8 @@ def main():
     if not config.get('disable_collection', False):
         log_info('Sending version information to singer.io. To disable sending anonymous usage data, set',
                  'the config parameter \'disable_collection'' to true.')
-        threading.Thread(target=send_usage_stats).start()
+        # Daemon thread, so that a slow collector never delays the exit of the target
+        threading.Thread(target=send_usage_stats, daemon=True).start()
 
     stdin_input = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
 
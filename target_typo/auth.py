@@ -0,0 +1,64 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import threading
+import time
+
+from target_typo.logging import log_debug
+
+
+class TokenManager():
+    '''
+    Keeps the access token and requests a new one before it expires or after Typo rejected it.
+    request_token returns a token and its lifetime in seconds, or None when the response has no lifetime.
+    Only one thread requests a token at a time, the others wait for it.
+    '''
+
+    def __init__(self, request_token, lifetime, refresh_margin):
+        self.request_token = request_token
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.refresh_at = 0.0
+
+    def set_token(self, token, lifetime=None):
+        lifetime = lifetime or self.lifetime
+        self.token = token
+        self.refresh_at = time.monotonic() + max(lifetime - self.refresh_margin, 0) if lifetime else float('inf')
+
+    def get(self):
+        '''
+        Returns a token that is not about to expire
+        '''
+        if self.token is not None and time.monotonic() < self.refresh_at:
+            return self.token
+
+        with self.lock:
+            # Another thread may have refreshed the token while this one was waiting
+            if self.token is None or time.monotonic() >= self.refresh_at:
+                log_debug('Requesting new token.')
+                self.set_token(*self.request_token())
+            return self.token
+
+    def invalidate(self, token):
+        '''
+        Called when a request with token got a 401 response. A new token is requested by the next get,
+        unless another thread already replaced it.
+        '''
+        with self.lock:
+            if self.token == token:
+                self.refresh_at = 0.0
@@ -0,0 +1,204 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import time
+
+from target_typo.codec import dumps_bytes
+
+
+# Size of the pieces of a streamed request body
+BODY_CHUNK_SIZE = 65536
+
+# Payload formats
+FORMAT_RECORDS = 'records'
+FORMAT_DATASETS = 'datasets'
+FORMAT_COLUMNS = 'columns'
+PAYLOAD_FORMATS = [FORMAT_RECORDS, FORMAT_DATASETS, FORMAT_COLUMNS]
+
+
+class DatasetBuffer():
+    '''
+    Records of one dataset waiting to be sent in the same batch.
+    With a codec, rows are kept as the UTF-8 JSON encoding of the records.
+    '''
+
+    def __init__(self, dataset, batch_number, codec=None):
+        self.dataset = dataset
+        self.batch_number = batch_number
+        self.codec = codec
+        self.encoded = codec is not None
+        self.rows = []
+        self.size = 0
+        # Bytes of the buffered bytes budget held by the batch
+        self.reserved = 0
+        # Position and size of the rows by key properties, when they are deduplicated
+        self.index = None
+        self.since = time.monotonic()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, row, size=0):
+        self.rows.append(row)
+        self.size += size
+
+    def records(self):
+        '''
+        Decoded records
+        '''
+        if self.encoded:
+            return [self.codec.loads(row.decode('utf-8')) for row in self.rows]
+        return self.rows
+
+    def part(self, rows):
+        '''
+        Buffer of the same batch with some of its rows
+        '''
+        part = DatasetBuffer(self.dataset, self.batch_number, self.codec)
+        part.rows = rows
+        return part
+
+
+class BodyStream():
+    '''
+    Request body of a batch, produced in chunks from the encoded rows when it is sent.
+    The length is known in advance, so the body is sent with a Content-Length header.
+    rows may also be read from a spool segment file, once for the length and again every time the body is sent.
+    '''
+
+    def __init__(self, prefix, separator, suffix, wrapper, rows):
+        self.prefix = prefix
+        self.separator = separator
+        self.suffix = suffix
+        # Text around every row, empty in the datasets format
+        self.wrapper = wrapper
+        self.rows = rows
+        wrapper_size = len(wrapper[0]) + len(wrapper[1])
+        self.length = len(prefix) + len(suffix) + sum(len(row) + wrapper_size for row in rows) + \
+            len(separator) * max(len(rows) - 1, 0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        before, after = self.wrapper
+        chunk = [self.prefix]
+        chunk_size = len(self.prefix)
+        for index, row in enumerate(self.rows):
+            if index:
+                chunk.append(self.separator)
+            chunk.append(before)
+            chunk.append(row)
+            chunk.append(after)
+            chunk_size += len(row)
+            if chunk_size >= BODY_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk = []
+                chunk_size = 0
+        chunk.append(self.suffix)
+        yield b''.join(chunk)
+
+
+def stream_batch(repository, batch, payload_format, codec):
+    '''
+    Streamed import payload of a batch, with the same content as the encoding of encode_batch by the codec
+    '''
+    rows = batch.rows if batch.encoded else [dumps_bytes(codec, row) for row in batch.records()]
+    separator = dumps_bytes(codec, [0, 0])[2:-2]
+    # Header of the payload, cut where the rows go
+    header = dumps_bytes(codec, {'repository': repository, 'dataset': batch.dataset, 'data': None})
+    header = header[:header.rindex(b'null')]
+
+    if payload_format == FORMAT_DATASETS:
+        return BodyStream(header + b'[', separator, b']}', (b'', b''), rows)
+
+    return BodyStream(b'[', separator, b']', (header, b'}'), rows)
+
+
+def encode_column(name, values):
+    '''
+    Column of the columns format. Columns of strings with repeated values are dictionary encoded: every distinct
+    string is listed once and the rows hold its index.
+    '''
+    dictionary = {}
+    strings = 0
+    for value in values:
+        if isinstance(value, str):
+            strings += 1
+            if value not in dictionary:
+                dictionary[value] = len(dictionary)
+        elif value is not None:
+            return {'name': name, 'values': values}
+
+    if not strings or len(dictionary) * 2 > strings:
+        return {'name': name, 'values': values}
+    return {
+        'name': name,
+        'dictionary': list(dictionary),
+        'indexes': [dictionary[value] if value is not None else None for value in values]
+    }
+
+
+def encode_columns(rows):
+    '''
+    Columns of the flattened rows of a batch, in the order their keys first appear. Rows missing a key hold None
+    in its column, and their positions are listed in the missing property of the column.
+    '''
+    names = list(dict.fromkeys(key for row in rows for key in row))
+    complete = all(len(row) == len(names) for row in rows)
+
+    columns = []
+    for name in names:
+        column = encode_column(name, [row.get(name) for row in rows])
+        if not complete:
+            missing = [index for index, row in enumerate(rows) if name not in row]
+            if missing:
+                column['missing'] = missing
+        columns.append(column)
+    return columns
+
+
+def encode_batch(repository, batch, payload_format):
+    '''
+    Builds the import payload of a batch.
+    The records format repeats repository and dataset on every record, the datasets format sends them once.
+    The columns format sends every key once, with the values of all the rows.
+    '''
+    if payload_format == FORMAT_COLUMNS:
+        rows = batch.records()
+        return {
+            'repository': repository,
+            'dataset': batch.dataset,
+            'format': FORMAT_COLUMNS,
+            'count': len(rows),
+            'columns': encode_columns(rows)
+        }
+
+    if payload_format == FORMAT_DATASETS:
+        return {
+            'repository': repository,
+            'dataset': batch.dataset,
+            'data': batch.records()
+        }
+
+    return [
+        {
+            'repository': repository,
+            'dataset': batch.dataset,
+            'data': row
+        }
+        for row in batch.records()
+    ]
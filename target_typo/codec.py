@@ -0,0 +1,197 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import importlib
+import json
+import math
+import re
+
+from target_typo.logging import log_debug, log_error
+
+
+CODEC_AUTO = 'auto'
+CODEC_JSON = 'json'
+CODEC_SIMPLEJSON = 'simplejson'
+CODEC_UJSON = 'ujson'
+CODEC_ORJSON = 'orjson'
+CODECS = [CODEC_AUTO, CODEC_ORJSON, CODEC_UJSON, CODEC_SIMPLEJSON, CODEC_JSON]
+
+# Integers that may not fit in 64 bits. orjson and ujson would turn them into floats or fail.
+# Digit runs starting after a quote, a letter or a digit, like string IDs, are not numbers and keep the fast path.
+LONG_NUMBER = re.compile(r'(?<![\w".])[0-9]{19}')
+
+
+class NonFiniteFloat(float):
+    '''
+    NaN and Infinity values parsed by the json fallback. Fast encoders reject this type, so payloads containing it
+    are encoded by the json module, which writes them back as NaN and Infinity.
+    '''
+
+
+def parse_constant(constant):
+    return NonFiniteFloat(constant)
+
+
+def parse_float(value):
+    number = float(value)
+    return number if math.isfinite(number) else NonFiniteFloat(number)
+
+
+def json_loads(data):
+    return json.loads(data, parse_float=parse_float, parse_constant=parse_constant)
+
+
+class JsonCodec():
+    '''
+    Standard library JSON codec, the reference for every other codec
+    '''
+    name = CODEC_JSON
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        '''
+        Returns a JSON document as str or as UTF-8 bytes
+        '''
+        return json.dumps(obj)
+
+
+class SimplejsonCodec(JsonCodec):
+    name = CODEC_SIMPLEJSON
+
+    def __init__(self, module):
+        self.module = module
+
+    def loads(self, data):
+        try:
+            return self.module.loads(data)
+        except ValueError:
+            # Recent simplejson versions reject NaN and Infinity. The json module raises the final decode error.
+            return json_loads(data)
+
+    def dumps(self, obj):
+        return self.module.dumps(obj, allow_nan=True)
+
+
+class UjsonCodec(JsonCodec):
+    name = CODEC_UJSON
+
+    def __init__(self, module):
+        self.module = module
+
+    def loads(self, data):
+        if LONG_NUMBER.search(data) is not None:
+            return json_loads(data)
+        try:
+            return self.module.loads(data)
+        except (ValueError, OverflowError):
+            return json_loads(data)
+
+    def dumps(self, obj):
+        try:
+            return self.module.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
+        except (ValueError, OverflowError, TypeError):
+            return json.dumps(obj)
+
+
+class OrjsonCodec(JsonCodec):
+    name = CODEC_ORJSON
+
+    def __init__(self, module):
+        self.module = module
+
+    def loads(self, data):
+        if LONG_NUMBER.search(data) is not None:
+            return json_loads(data)
+        try:
+            return self.module.loads(data)
+        except self.module.JSONDecodeError:
+            # NaN, Infinity, out of range floats and lone surrogates are only accepted by the json module
+            return json_loads(data)
+
+    def dumps(self, obj):
+        try:
+            return self.module.dumps(obj)
+        except self.module.JSONEncodeError:
+            # Integers over 64 bits, NaN and Infinity
+            return json.dumps(obj)
+
+
+class AutoCodec(JsonCodec):
+    '''
+    Parses with the fastest installed codec and encodes with the json module, so that request bodies stay
+    identical to the ones of the json codec
+    '''
+    name = CODEC_AUTO
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def loads(self, data):
+        return self.parser.loads(data)
+
+
+def dumps_text(codec, obj):
+    '''
+    JSON document of an object as str. Some codecs return UTF-8 bytes.
+    '''
+    text = codec.dumps(obj)
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
+
+def dumps_bytes(codec, obj):
+    '''
+    JSON document of an object as UTF-8 bytes
+    '''
+    data = codec.dumps(obj)
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+CODEC_CLASSES = {
+    CODEC_ORJSON: OrjsonCodec,
+    CODEC_UJSON: UjsonCodec,
+    CODEC_SIMPLEJSON: SimplejsonCodec,
+}
+
+
+def get_codec(name=CODEC_AUTO):
+    '''
+    Returns the configured codec. auto parses with the fastest installed one and encodes with the json module.
+    '''
+    names = [CODEC_ORJSON, CODEC_UJSON, CODEC_SIMPLEJSON] if name == CODEC_AUTO else [name]
+
+    for codec_name in names:
+        if codec_name == CODEC_JSON:
+            break
+        try:
+            module = importlib.import_module(codec_name)
+        except ImportError:
+            if name != CODEC_AUTO:
+                log_error('JSON codec "%s" is not installed. Falling back to "json".', codec_name)
+            continue
+        codec = CODEC_CLASSES[codec_name](module)
+        if name == CODEC_AUTO:
+            log_debug('Parsing with JSON codec "%s".', codec_name)
+            return AutoCodec(codec)
+        log_debug('Using JSON codec "%s".', codec_name)
+        return codec
+
+    return JsonCodec()
@@ -0,0 +1,76 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import zlib
+
+from target_typo.logging import log_error
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+COMPRESSION_METHODS = [COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_ZSTD]
+# Lowest and highest compression_level accepted by each compressor
+COMPRESSION_LEVELS = {
+    COMPRESSION_GZIP: (-1, 9),
+    COMPRESSION_ZSTD: (-131072, 22)
+}
+
+# zlib wbits value producing a gzip container
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def resolve_compression(method):
+    '''
+    Returns the compression method that can be used in this environment
+    '''
+    if method == COMPRESSION_ZSTD and zstandard is None:
+        log_error('Compression "zstd" requires the zstandard package. Falling back to "gzip".')
+        return COMPRESSION_GZIP
+    return method
+
+
+def compress(body, method, level=None):
+    '''
+    Compresses a request body with the given Content-Encoding method
+    '''
+    if method == COMPRESSION_GZIP:
+        compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    if method == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(body)
+
+    return body
+
+
+def compress_chunks(chunks, method, level=None):
+    '''
+    Compresses a request body produced in chunks, without joining the uncompressed chunks
+    '''
+    if method == COMPRESSION_GZIP:
+        compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, GZIP_WBITS)
+    else:
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+    compressed = [compressor.compress(chunk) for chunk in chunks]
+    compressed.append(compressor.flush())
+    return b''.join(compressed)
@@ -19,3 +19,8 @@
 TYPE_RECORD = 'RECORD'
 TYPE_STATE = 'STATE'
 TYPE_SCHEMA = 'SCHEMA'
+
+# Engines reading the input and sending the batches
+ENGINE_SYNC = 'sync'
+ENGINE_ASYNC = 'async'
+ENGINES = [ENGINE_SYNC, ENGINE_ASYNC]
@@ -0,0 +1,59 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import threading
+
+from target_typo.codec import dumps_text
+from target_typo.logging import log_error
+
+
+# Client errors caused by the content of the records of a batch. Other client errors, such as 403 or 404, refuse
+# every record and stop the target.
+REJECTED_RECORDS_STATUSES = (400, 413, 422)
+
+
+class DeadLetterFile():
+    '''
+    NDJSON file of the records rejected by Typo, with the response of the import request.
+    The file is only created when a record is rejected.
+    '''
+
+    def __init__(self, path, codec):
+        self.path = path
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.file = None
+        self.count = 0
+
+    def write(self, dataset, record, status, response):
+        error = response.get('message', response) if isinstance(response, dict) else response
+        line = dumps_text(self.codec, {'dataset': dataset, 'record': record, 'status': status, 'error': error})
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.count += 1
+        log_error('Dataset %s: Typo rejected a record with status code %s: %s. It was written to %s.', dataset,
+                  status, error, self.path)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.count:
+                log_error('%s records rejected by Typo were written to %s.', self.count, self.path)
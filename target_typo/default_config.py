@@ -16,5 +16,41 @@
 
 
 DEFAULTS = {
-    'send_threshold': 100
+    'send_threshold': 100,
+    'payload_format': 'records',
+    'json_codec': 'auto',
+    'max_batch_bytes': 0,
+    'linger_ms': 0,
+    'max_state_delay_ms': 30000,
+    'upload_workers': 0,
+    'upload_queue_size': 4,
+    'http_pool_size': 10,
+    'connect_timeout': 10,
+    'read_timeout': 120,
+    'max_requests_per_second': 0,
+    'max_bytes_per_second': 0,
+    'compression': 'none',
+    'compression_min_bytes': 1024,
+    'stream_body': False,
+    'adaptive_batching': False,
+    'min_send_threshold': 10,
+    'max_send_threshold': 200,
+    'send_threshold_step': 10,
+    'target_latency_ms': 1000,
+    'token_lifetime_s': 3600,
+    'token_refresh_margin_s': 300,
+    'metrics_interval_s': 0,
+    'workers': 0,
+    'worker_chunk_size': 500,
+    'engine': 'sync',
+    'async_concurrency': 8,
+    'state_interval_ms': 0,
+    'state_interval_records': 0,
+    'validation_mode': 'full',
+    'validation_n': 1000,
+    'validation_seed': 0,
+    'flatten_key_cache_size': 10000,
+    'max_buffered_bytes': 0,
+    'memory_report': False,
+    'deduplicate': False
 }
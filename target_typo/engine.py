@@ -0,0 +1,175 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import asyncio
+import concurrent.futures
+import itertools
+import threading
+
+# Results read from the input at a time, and chunks read ahead of the ones being handled
+READ_CHUNK_SIZE = 500
+READ_AHEAD = 2
+
+
+class AsyncUploader():
+    '''
+    Sends batches from the event loop with up to concurrency import requests in flight.
+    The requests run in a thread pool sharing the connection pool, token and rate limiter of the target.
+    Takes the place of BatchUploader in the async engine.
+    '''
+
+    def __init__(self, send_batch, concurrency, loop):
+        self.send_batch = send_batch
+        self.concurrency = concurrency
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency, thread_name_prefix='typo-async')
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.error = None
+
+    def submit(self, batch):
+        self.raise_error()
+        future = self.loop.run_in_executor(self.executor, self._send, batch)
+        self.in_flight.add(future)
+        future.add_done_callback(self.in_flight.discard)
+
+    def _send(self, batch):
+        try:
+            self.send_batch(batch)
+        except BaseException as err:
+            # Kept by the sender thread: loop callbacks do not run while the loop waits for the budget
+            with self.lock:
+                if self.error is None:
+                    self.error = err
+            raise
+
+    async def wait_budget(self, typo):
+        '''
+        Waits in a thread until the buffered bytes are back within the budget, sending large buffers first
+        '''
+        typo.flush_for_budget(0)
+        await self.loop.run_in_executor(None, typo.budget.wait, self.raise_error)
+
+    async def wait_capacity(self):
+        '''
+        Waits while twice as many batches as the concurrency are being sent or waiting for a thread
+        '''
+        while len(self.in_flight) >= self.concurrency * 2 and self.error is None:
+            await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+        self.raise_error()
+
+    async def close(self):
+        '''
+        Waits for every batch to be acknowledged
+        '''
+        if self.in_flight:
+            await asyncio.wait(self.in_flight)
+        self.executor.shutdown()
+        self.raise_error()
+
+    def abort(self):
+        # Batches waiting for a thread are cancelled, the ones being sent finish in their threads
+        for future in list(self.in_flight):
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+def read_results(results, loop, chunks, stopped, errors):
+    '''
+    Reads the results in a thread, so that waiting for stdin never blocks the event loop.
+    An empty chunk marks the end of the input. The input is closed by this thread, which is the one reading it.
+    '''
+    try:
+        lines = iter(results)
+        while not stopped.is_set():
+            try:
+                chunk = list(itertools.islice(lines, READ_CHUNK_SIZE))
+            except BaseException as err:  # pylint: disable=W0703
+                # Raised again by the event loop
+                errors.append(err)
+                chunk = []
+            try:
+                asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+            except (RuntimeError, concurrent.futures.CancelledError):
+                # The event loop stopped on an error and takes no more input
+                return
+            if not chunk:
+                return
+    finally:
+        if hasattr(results, 'close'):
+            results.close()
+
+
+async def consume(typo, results, handle, concurrency):
+    loop = asyncio.get_running_loop()
+    uploader = AsyncUploader(typo.send_batch, concurrency, loop)
+    typo.uploader = uploader
+    typo.wait_for_budget = False
+    budget = typo.budget
+    chunks = asyncio.Queue(maxsize=READ_AHEAD)
+    stopped = threading.Event()
+    errors = []
+    # Daemon thread: when the target stops on an error, a reader waiting for stdin must not keep it running
+    reader = threading.Thread(target=read_results, args=(results, loop, chunks, stopped, errors), name='typo-reader',
+                              daemon=True)
+    reader.start()
+    # Without input, records waiting for longer than linger_ms are still sent and due states emitted
+    intervals = (typo.linger, typo.max_state_delay, typo.tracker.interval)
+    timeout = min([interval for interval in intervals if interval] or [None])
+
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.get(), timeout)
+            except asyncio.TimeoutError:
+                typo.check_linger()
+                typo.check_state_delay()
+                typo.tracker.check()
+                continue
+
+            if not chunk:
+                if errors:
+                    raise errors[0]
+                break
+            for result in chunk:
+                handle(result)
+                if budget is not None and budget.used > budget.max_bytes:
+                    await uploader.wait_budget(typo)
+            await uploader.wait_capacity()
+
+        for dataset in list(typo.buffers):
+            typo.flush_dataset(dataset)
+        await uploader.close()
+    except BaseException:
+        stopped.set()
+        uploader.abort()
+        raise
+    finally:
+        typo.uploader = None
+        typo.wait_for_budget = True
+
+    reader.join()
+
+
+def run_async(typo, results, handle, concurrency):
+    '''
+    Passes every result to handle in an event loop, with up to concurrency import requests in flight
+    '''
+    asyncio.run(consume(typo, results, handle, concurrency))
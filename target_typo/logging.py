@@ -32,12 +32,33 @@
 #
 # or by Typo (https://www.typo.ai/).
 
+import importlib.util
+import logging
+import logging.config
+import os
 import sys
-import pkg_resources
-import singer
+
+from target_typo.utils import get_version
+
+
+def get_logger():
+    '''
+    Returns the Singer logger. singer-python is only imported when its logging.conf cannot be found, since
+    importing the whole package takes a significant part of the startup time.
+    '''
+    spec = importlib.util.find_spec('singer')
+    if spec is not None and spec.submodule_search_locations:
+        path = os.path.join(list(spec.submodule_search_locations)[0], 'logging.conf')
+        if os.path.isfile(path):
+            logging.config.fileConfig(path, disable_existing_loggers=False)
+            return logging.getLogger()
+
+    import singer  # pylint: disable=import-outside-toplevel
+    return singer.get_logger()
+
 
 # Singer Logger
-LOGGER = singer.get_logger()
+LOGGER = get_logger()
 
 
 def format_log_message(message, new_line):
@@ -45,7 +66,7 @@ def format_log_message(message, new_line):
     Adds target-typo label and version to log messages
     '''
     return '\'target-typo:{}\'{}{}'.format(
-        pkg_resources.get_distribution('target_typo').version,
+        get_version(),
         '\n' if new_line else ' ',
         message
     )
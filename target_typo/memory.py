@@ -0,0 +1,127 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import threading
+import time
+import tracemalloc
+
+from target_typo.logging import log_debug, log_info
+
+
+# Allocation sites listed by the memory report
+MEMORY_REPORT_TOP = 10
+
+# Seconds between the error checks of a reservation waiting for the budget
+CHECK_INTERVAL = 0.5
+
+
+class MemoryBudget():
+    '''
+    Bytes of the records buffered, queued or being sent, shared by every thread.
+    A reservation larger than the whole budget is allowed when nothing else is reserved, so one huge record cannot
+    block the target forever.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _take(self, size):
+        if self.used and self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        return True
+
+    def try_acquire(self, size):
+        with self.condition:
+            return self._take(size)
+
+    def acquire(self, size, check=None):
+        '''
+        Waits until size bytes are released. check is called every CHECK_INTERVAL seconds while waiting, to raise
+        the errors of the threads that release the budget.
+        '''
+        with self.condition:
+            if not self._take(size):
+                self._wait(lambda: self._take(size), check)
+
+    def force(self, size):
+        '''
+        Reserves size bytes even over the budget. The caller waits for the budget afterwards.
+        '''
+        with self.condition:
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def wait(self, check=None):
+        '''
+        Waits until the reserved bytes are back within the budget
+        '''
+        with self.condition:
+            if self.used > self.max_bytes:
+                self._wait(lambda: self.used <= self.max_bytes, check)
+
+    def _wait(self, predicate, check):
+        self.waits += 1
+        log_debug('Buffered bytes budget of %s reached, waiting for batches to be sent.', self.max_bytes)
+        started = time.perf_counter()
+        try:
+            while not predicate():
+                if check is not None:
+                    check()
+                self.condition.wait(CHECK_INTERVAL)
+        finally:
+            self.wait_seconds += time.perf_counter() - started
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+    def gauges(self):
+        with self.condition:
+            return {
+                'buffered_bytes': self.used,
+                'buffered_bytes_peak': self.peak,
+                'backpressure_waits': self.waits,
+                'backpressure_seconds': self.wait_seconds
+            }
+
+
+def start_memory_report():
+    tracemalloc.start()
+
+
+def log_memory_report():
+    '''
+    Logs the peak of the memory traced since start_memory_report and the sites holding the most memory
+    '''
+    if not tracemalloc.is_tracing():
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    log_info('Memory traced: peak %.1f MiB, at exit %.1f MiB.', peak / 2 ** 20, current / 2 ** 20)
+    for stat in snapshot.statistics('lineno')[:MEMORY_REPORT_TOP]:
+        frame = stat.traceback[0]
+        log_info('Memory at exit: %.1f KiB in %s blocks at %s:%s.', stat.size / 1024, stat.count, frame.filename,
+                 frame.lineno)
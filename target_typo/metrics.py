@@ -0,0 +1,252 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import json
+import threading
+import time
+
+from target_typo.logging import log_info
+
+
+# Stages of the hot path, in processing order
+STAGE_READ = 'read'
+STAGE_PARSE = 'parse'
+STAGE_VALIDATE = 'validate'
+STAGE_FLATTEN = 'flatten'
+STAGE_ENQUEUE = 'enqueue'
+STAGE_SERIALIZE = 'serialize'
+STAGE_HTTP = 'http'
+STAGE_STATE = 'state'
+STAGES = [STAGE_READ, STAGE_PARSE, STAGE_VALIDATE, STAGE_FLATTEN, STAGE_ENQUEUE, STAGE_SERIALIZE, STAGE_HTTP,
+          STAGE_STATE]
+
+# Upper bounds of the import latency histogram buckets, in milliseconds. The last bucket has no bound.
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Counters of every stream, with the name of their Singer metric
+STREAM_COUNTERS = {
+    'records': 'record_count',
+    'bytes': 'byte_count',
+    'batches': 'batch_count',
+    'retries': 'retry_count',
+    'validated': 'validated_count',
+    'validation_skipped': 'validation_skipped_count',
+    'key_cache_hits': 'key_cache_hit_count',
+    'key_cache_misses': 'key_cache_miss_count',
+    'collapsed': 'collapsed_count'
+}
+
+
+def new_stages():
+    return {stage: [0, 0.0] for stage in STAGES}
+
+
+def merge_stages(stages, other):
+    for stage, (count, seconds) in other.items():
+        stages[stage][0] += count
+        stages[stage][1] += seconds
+
+
+class StageTimer():
+    '''
+    Adds the time elapsed since the previous lap to a stage. Used for the stages of every record.
+    '''
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.last = 0.0
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        totals = self.stages[stage]
+        totals[0] += 1
+        totals[1] += now - self.last
+        self.last = now
+
+
+class NullTimer():
+    '''
+    Stage timer used when metrics are disabled
+    '''
+
+    def start(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timed_lines(lines, timer):
+    '''
+    Yields the input lines, adding the time spent waiting for each of them to the read stage
+    '''
+    lines = iter(lines)
+    while True:
+        timer.start()
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        timer.lap(STAGE_READ)
+        yield line
+
+
+def new_stream():
+    stream = {counter: 0 for counter in STREAM_COUNTERS}
+    stream['latency'] = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    return stream
+
+
+def latency_bucket(latency):
+    milliseconds = latency * 1000
+    for index, bound in enumerate(LATENCY_BUCKETS_MS):
+        if milliseconds <= bound:
+            return index
+    return len(LATENCY_BUCKETS_MS)
+
+
+class Metrics():
+    '''
+    Time spent in every stage and per stream counters, logged as Singer METRIC lines every interval seconds
+    and written to summary_file at exit
+    '''
+
+    def __init__(self, interval=0, summary_file=None):
+        self.interval = interval
+        self.summary_file = summary_file
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.stages = new_stages()
+        self.streams = {}
+        # Totals at the previous report, Singer metrics are logged as the change since then
+        self.reported_stages = new_stages()
+        self.reported_streams = {}
+        self.timer = StageTimer(self.stages)
+        # Functions returning current values, like the request rate
+        self.gauge_sources = []
+
+    def add_time(self, stage, seconds, count=1):
+        with self.lock:
+            totals = self.stages[stage]
+            totals[0] += count
+            totals[1] += seconds
+
+    def add_stages(self, stages):
+        with self.lock:
+            merge_stages(self.stages, stages)
+
+    def stream(self, dataset):
+        if dataset not in self.streams:
+            self.streams[dataset] = new_stream()
+        return self.streams[dataset]
+
+    def add_import(self, dataset, records, size, latency):
+        with self.lock:
+            stream = self.stream(dataset)
+            stream['records'] += records
+            stream['bytes'] += size
+            stream['batches'] += 1
+            stream['latency'][latency_bucket(latency)] += 1
+
+    def add_retry(self, dataset):
+        with self.lock:
+            self.stream(dataset)['retries'] += 1
+
+    def set_counters(self, dataset, counters):
+        '''
+        Sets counters that are totals of the run, like the validated records
+        '''
+        with self.lock:
+            self.stream(dataset).update(counters)
+
+    def gauges(self):
+        values = {}
+        for source in self.gauge_sources:
+            values.update(source())
+        return values
+
+    def check_report(self):
+        '''
+        Logs the metrics when the report interval has passed
+        '''
+        if self.interval and time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        with self.lock:
+            self.last_report = time.monotonic()
+            for stage in STAGES:
+                count = self.stages[stage][0] - self.reported_stages[stage][0]
+                if count:
+                    log_metric('timer', 'stage_duration', self.stages[stage][1] - self.reported_stages[stage][1],
+                               {'stage': stage, 'count': count})
+            self.reported_stages = {stage: list(totals) for stage, totals in self.stages.items()}
+
+            for dataset, stream in self.streams.items():
+                reported = self.reported_streams.get(dataset, new_stream())
+                for counter, metric in STREAM_COUNTERS.items():
+                    if stream[counter] != reported[counter]:
+                        log_metric('counter', metric, stream[counter] - reported[counter], {'endpoint': dataset})
+                self.reported_streams[dataset] = dict(stream, latency=list(stream['latency']))
+
+        for metric, value in self.gauges().items():
+            log_metric('gauge', metric, value, {})
+
+    def summary(self):
+        gauges = self.gauges()
+        with self.lock:
+            return {
+                'duration_seconds': time.monotonic() - self.started,
+                'gauges': gauges,
+                'stages': {
+                    stage: {'count': count, 'seconds': seconds}
+                    for stage, (count, seconds) in self.stages.items()
+                },
+                'streams': {
+                    dataset: dict(
+                        {counter: stream[counter] for counter in STREAM_COUNTERS},
+                        latency_ms={
+                            'le_{}'.format(bound) if bound is not None else 'inf': count
+                            for bound, count in zip(LATENCY_BUCKETS_MS + [None], stream['latency'])
+                        }
+                    )
+                    for dataset, stream in self.streams.items()
+                }
+            }
+
+    def close(self):
+        '''
+        Logs the last metrics and writes the summary file
+        '''
+        if self.interval:
+            self.report()
+        if self.summary_file:
+            with open(self.summary_file, 'w') as summary_output:
+                json.dump(self.summary(), summary_output, indent=2)
+
+
+def log_metric(metric_type, metric, value, tags):
+    '''
+    Logs a metric in the format of singer-python metrics
+    '''
+    log_info('METRIC: %s', json.dumps({'type': metric_type, 'metric': metric, 'value': value, 'tags': tags}))
@@ -0,0 +1,192 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import collections
+import queue
+import threading
+import time
+
+from target_typo.logging import log_critical
+from target_typo.metrics import STAGE_STATE
+from target_typo.utils import emit_state
+
+
+class AckTracker():
+    '''
+    Keeps Singer STATE messages until every batch submitted before them has been acknowledged.
+    Only the latest safe state is kept, it is emitted once interval seconds have passed or records_interval records
+    have been acknowledged since the previous emission, and by close. With both set to 0 a state is emitted as soon
+    as it is safe. on_emit is called with every state emitted.
+    '''
+
+    def __init__(self, on_emit=None, metrics=None, interval=0, records_interval=0):
+        self.on_emit = on_emit
+        self.metrics = metrics
+        self.interval = interval
+        self.records_interval = records_interval
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.acked_through = 0
+        self.acked_ahead = set()
+        self.states = collections.deque()
+        # Latest safe state not emitted yet, wrapped in a tuple
+        self.safe = None
+        self.last_emit = time.monotonic()
+        self.acked_records = 0
+
+    def submit(self, batch_number):
+        '''
+        Registers a batch number that states received from now on have to wait for
+        '''
+        with self.lock:
+            self.submitted = max(self.submitted, batch_number)
+
+    def add_state(self, state):
+        '''
+        Registers a state covering every batch submitted so far
+        '''
+        with self.lock:
+            self.states.append((self.submitted, state, time.monotonic()))
+            self._collect_safe_states()
+            self._emit_if_due()
+
+    def ack(self, batch_number, records=0):
+        with self.lock:
+            self.acked_records += records
+            self.acked_ahead.add(batch_number)
+            while self.acked_through + 1 in self.acked_ahead:
+                self.acked_through += 1
+                self.acked_ahead.remove(self.acked_through)
+            self._collect_safe_states()
+            self._emit_if_due()
+
+    def check(self):
+        '''
+        Emits the latest safe state when the interval has passed
+        '''
+        if self.safe is None:
+            return
+        with self.lock:
+            self._emit_if_due()
+
+    def close(self):
+        '''
+        Emits the latest safe state, if it was not emitted yet
+        '''
+        with self.lock:
+            self._collect_safe_states()
+            if self.safe is not None:
+                self._emit()
+
+    def _collect_safe_states(self):
+        # Only the latest safe state needs to be emitted, the older ones are covered by it
+        while self.states and self.states[0][0] <= self.acked_through:
+            self.safe = (self.states.popleft()[1],)
+
+    def oldest_pending(self):
+        '''
+        Last batch number the oldest unsafe state waits for, and the time it was received, or None
+        '''
+        if not self.states:
+            return None
+        with self.lock:
+            if not self.states:
+                return None
+            batch_number, _, received = self.states[0]
+            return batch_number, received
+
+    def _emit_if_due(self):
+        if self.safe is None:
+            return
+        due = not self.interval and not self.records_interval
+        if self.interval and time.monotonic() - self.last_emit >= self.interval:
+            due = True
+        if self.records_interval and self.acked_records >= self.records_interval:
+            due = True
+        if due:
+            self._emit()
+
+    def _emit(self):
+        started = time.perf_counter()
+        state = self.safe[0]
+        self.safe = None
+        self.last_emit = time.monotonic()
+        self.acked_records = 0
+        emit_state(state)
+        if self.on_emit is not None:
+            self.on_emit(state)
+        if self.metrics is not None:
+            self.metrics.add_time(STAGE_STATE, time.perf_counter() - started)
+
+
+class BatchUploader():
+    '''
+    Sends batches in background threads through a bounded queue
+    '''
+
+    def __init__(self, send_batch, workers, queue_size):
+        self.send_batch = send_batch
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._worker, name='typo-uploader-{}'.format(index), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, batch):
+        '''
+        Hands a batch over to the sender workers. Blocks while the queue is full.
+        '''
+        self.raise_error()
+        while True:
+            try:
+                self.queue.put(batch, timeout=0.5)
+                return
+            except queue.Full:
+                self.raise_error()
+
+    def close(self):
+        '''
+        Waits for every queued batch to be acknowledged and stops the workers
+        '''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _worker(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                # Another worker failed, drain the queue without sending
+                continue
+
+            try:
+                self.send_batch(batch)
+            except BaseException as err:  # pylint: disable=W0703
+                # post_request exits the process on fatal errors. In a worker thread that would only stop the
+                # thread, so the error is kept and raised again in the main thread.
+                if not isinstance(err, SystemExit):
+                    log_critical('Batch %s: Upload failed.', batch.batch_number, exc_info=True)
+                self.error = err
@@ -0,0 +1,246 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import collections
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+
+from jsonschema.exceptions import ValidationError, SchemaError
+
+from target_typo.codec import get_codec
+from target_typo.constants import TYPE_RECORD, TYPE_SCHEMA, TYPE_STATE
+from target_typo.metrics import NULL_TIMER, STAGE_FLATTEN, STAGE_PARSE, STAGE_VALIDATE, StageTimer, new_stages
+from target_typo.utils import KeyCache, build_flatten_plan, flatten, flatten_with_plan
+from target_typo.validation import ValidationSampler, get_validator
+
+
+# Result of a line that stops the target. It holds the arguments of log_critical.
+TYPE_ERROR = 'ERROR'
+
+
+class MessageProcessor():
+    '''
+    Decodes, validates and flattens input lines.
+    Results are tuples starting with the message type:
+    (RECORD, stream, flattened record), (STATE, message), (SCHEMA, message) or (ERROR, log arguments...)
+    '''
+
+    def __init__(self, codec, timer=NULL_TIMER, sampler=None, key_cache_size=0):
+        self.codec = codec
+        self.timer = timer
+        self.sampler = sampler if sampler is not None else ValidationSampler()
+        self.key_cache_size = key_cache_size
+        self.validators = {}
+        self.flatten_plans = {}
+        # Flattened keys of every stream
+        self.key_caches = {}
+
+    def set_schema(self, stream, schema):
+        self.validators[stream] = get_validator(schema)
+        self.flatten_plans[stream] = build_flatten_plan(schema)
+
+    def process(self, raw_message):
+        timer = self.timer
+        timer.start()
+        try:
+            message = self.codec.loads(raw_message)
+        except json.decoder.JSONDecodeError:
+            return (TYPE_ERROR, 'Unable to parse line: %s', raw_message)
+        timer.lap(STAGE_PARSE)
+
+        if 'type' not in message:
+            return (TYPE_ERROR, 'Line is missing required key \'type\': %s', raw_message)
+
+        message_type = message['type']
+
+        if message_type == TYPE_RECORD:
+            stream = message['stream']
+
+            # Validate message, or the records chosen by the validation mode
+            if stream in self.validators and self.sampler.should_validate(stream, raw_message):
+                try:
+                    self.validators[stream].validate(message['record'])
+                except ValidationError as err:
+                    return (TYPE_ERROR, err)
+                except SchemaError as err:
+                    return (TYPE_ERROR, 'Invalid schema: %s', err)
+                timer.lap(STAGE_VALIDATE)
+
+            # If the message has properties with JSON sub-properties, they will
+            # be flattened like "a": {"b": 1, "c": 2} -> {"a__b": 1, "a__c": 2}
+            cache = None
+            if self.key_cache_size:
+                cache = self.key_caches.get(stream)
+                if cache is None:
+                    cache = self.key_caches[stream] = KeyCache(self.key_cache_size)
+            if stream in self.flatten_plans:
+                flattened = flatten_with_plan(message['record'], self.flatten_plans[stream], cache=cache)
+            else:
+                flattened = flatten(message['record'], cache=cache)
+            timer.lap(STAGE_FLATTEN)
+            return (TYPE_RECORD, stream, flattened)
+
+        if message_type == TYPE_STATE:
+            if 'value' not in message:
+                return (TYPE_ERROR, 'Received a STATE message without value property: %s', message)
+            return (TYPE_STATE, message)
+
+        if message_type == TYPE_SCHEMA:
+            if 'stream' not in message:
+                return (TYPE_ERROR, 'Line is missing required key "stream": %s', raw_message)
+            # A missing schema property is reported in order by persist_lines
+            if 'schema' in message:
+                self.set_schema(message['stream'], message['schema'])
+            return (TYPE_SCHEMA, message)
+
+        return None
+
+    def counters(self):
+        '''
+        Validated and skipped records and key cache hits and misses of every stream
+        '''
+        counters = {}
+        for stream, (validated, skipped) in self.sampler.counts.items():
+            counters[stream] = {'validated': validated, 'validation_skipped': skipped}
+        for stream, cache in self.key_caches.items():
+            counters.setdefault(stream, {}).update(key_cache_hits=cache.hits, key_cache_misses=cache.misses)
+        return counters
+
+    def process_chunk(self, lines):
+        results = []
+        for raw_message in lines:
+            result = self.process(raw_message)
+            if result is not None:
+                results.append(result)
+                if result[0] == TYPE_ERROR:
+                    break
+        return results
+
+
+# Processor of each worker process, with the version of the schemas it was built with
+WORKER = {}
+
+
+def init_worker(codec_name, timed, validation, key_cache_size):
+    WORKER['processor'] = MessageProcessor(get_codec(codec_name), StageTimer(new_stages()) if timed else NULL_TIMER,
+                                           ValidationSampler(*validation), key_cache_size)
+    WORKER['version'] = None
+
+
+def process_chunk(lines, version, schemas):
+    '''
+    Processes a chunk of lines in a worker process. schemas are the schemas known before the first line.
+    Returns the results, the time spent in each stage, if measured, and the counters of the process.
+    '''
+    processor = WORKER['processor']
+    if WORKER['version'] != version:
+        processor.validators = {}
+        processor.flatten_plans = {}
+        for stream, schema in schemas.items():
+            processor.set_schema(stream, schema)
+
+    results = processor.process_chunk(lines)
+    # SCHEMA messages of this chunk changed the processor, it is rebuilt for the next chunk
+    WORKER['version'] = None if any(result[0] == TYPE_SCHEMA for result in results) else version
+
+    stages = None
+    if processor.timer is not NULL_TIMER:
+        stages = processor.timer.stages
+        processor.timer.stages = new_stages()
+    return results, stages, (os.getpid(), processor.counters())
+
+
+class ParallelProcessor():
+    '''
+    Processes chunks of lines in a pool of processes and returns the results in input order.
+    SCHEMA messages are detected when a chunk is read, so that the following chunks are processed with them.
+    '''
+
+    def __init__(self, codec, workers, chunk_size, metrics=None, sampler=None, key_cache_size=0):
+        self.codec = codec
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.sampler = sampler if sampler is not None else ValidationSampler()
+        self.key_cache_size = key_cache_size
+        # Counters of every worker process
+        self.worker_counters = {}
+        self.schemas = {}
+        self.version = 0
+
+    def scan_schemas(self, lines):
+        for raw_message in lines:
+            if '"SCHEMA"' not in raw_message:
+                continue
+            try:
+                message = self.codec.loads(raw_message)
+            except json.decoder.JSONDecodeError:
+                continue
+            if isinstance(message, dict) and message.get('type') == TYPE_SCHEMA and 'stream' in message \
+                    and 'schema' in message:
+                self.schemas[message['stream']] = message['schema']
+                self.version += 1
+
+    def results(self, messages):
+        messages = iter(messages)
+        pending = collections.deque()
+        # The target already runs threads holding locks, like the uploaders and the HTTP connection pool. Workers
+        # forked from it could inherit locks that are never released, so they start from a fresh process.
+        # mp_context and initializer need Python 3.7, the minimum version declared in setup.py.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context, initializer=init_worker,
+                initargs=(self.codec.name, self.metrics is not None,
+                          (self.sampler.mode, self.sampler.n, self.sampler.seed), self.key_cache_size)) as pool:
+            while True:
+                # Keep two chunks per worker in flight
+                while len(pending) < self.workers * 2:
+                    lines = list(itertools.islice(messages, self.chunk_size))
+                    if not lines:
+                        break
+                    pending.append(pool.submit(process_chunk, lines, self.version, dict(self.schemas)))
+                    self.scan_schemas(lines)
+
+                if not pending:
+                    return
+
+                results, stages, (pid, counters) = pending.popleft().result()
+                if stages is not None:
+                    self.metrics.add_stages(stages)
+                self.worker_counters[pid] = counters
+
+                for result in results:
+                    yield result
+                    if result[0] == TYPE_ERROR:
+                        for future in pending:
+                            future.cancel()
+                        return
+
+    def counters(self):
+        '''
+        Counters of every stream, summed over the worker processes
+        '''
+        counters = {}
+        for worker_counters in self.worker_counters.values():
+            for stream, stream_counters in worker_counters.items():
+                totals = counters.setdefault(stream, {})
+                for counter, value in stream_counters.items():
+                    totals[counter] = totals.get(counter, 0) + value
+        return counters
@@ -0,0 +1,176 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import collections
+import email.utils
+import threading
+import time
+
+from target_typo.logging import log_info
+
+
+# Attempts of a request answered with 429 Too Many Requests
+THROTTLED_MAX_TRIES = 10
+
+# Lowest request rate after 429 responses, and growth of the rate after every accepted request
+MIN_REQUEST_RATE = 0.1
+RECOVERY_FACTOR = 1.05
+# Without a configured rate, the limit set after 429 responses is removed once it grows over this rate
+UNLIMITED_REQUEST_RATE = 1000.0
+
+# Requests used to measure the current request rate
+RATE_WINDOW = 50
+
+
+def parse_retry_after(value):
+    '''
+    Seconds to wait from a Retry-After header, given in seconds or as an HTTP date
+    '''
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket():
+    '''
+    Allows rate units per second, with bursts of one second. An amount larger than the burst is allowed once the
+    bucket is full, and the following ones wait for the debt to be paid.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.refill(time.monotonic())
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+class RateLimiter():
+    '''
+    Limits the requests per second and the request bytes per second of all the requests to Typo.
+    A rate of 0 means no limit. After a 429 response, every request waits for the Retry-After time and the
+    request rate is halved, then it grows back with every accepted request.
+    '''
+
+    def __init__(self, requests_per_second=0, bytes_per_second=0):
+        self.lock = threading.Lock()
+        self.max_request_rate = requests_per_second
+        self.request_rate = requests_per_second
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.resume_at = 0.0
+        self.throttled = 0
+        self.sent = collections.deque(maxlen=RATE_WINDOW)
+
+    def acquire(self, size):
+        '''
+        Waits until a request of size bytes can be sent
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.resume_at - now
+                if wait <= 0:
+                    buckets = [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.bytes, size))
+                               if bucket is not None]
+                    for bucket, _ in buckets:
+                        bucket.refill(now)
+                    wait = max([bucket.wait_time(amount) for bucket, amount in buckets] + [0.0])
+                    if wait <= 0:
+                        for bucket, amount in buckets:
+                            bucket.tokens -= amount
+                        self.sent.append(now)
+                        return
+            time.sleep(wait)
+
+    def throttle(self, retry_after):
+        '''
+        Called after a 429 response. retry_after is the time asked by Typo, in seconds, if any.
+        '''
+        with self.lock:
+            self.throttled += 1
+            pause = retry_after if retry_after is not None else min(2 ** (self.throttled - 1), 60)
+            self.resume_at = max(self.resume_at, time.monotonic() + pause)
+
+            rate = max((self.request_rate or self.current_rate() or 1.0) / 2, MIN_REQUEST_RATE)
+            self.set_request_rate(rate)
+            log_info('Typo returned status code 429. Waiting %.1f seconds and sending at most %.2f requests per '
+                     'second.', pause, rate)
+
+    def success(self):
+        '''
+        Called after a request that was not throttled
+        '''
+        if self.request_rate == self.max_request_rate and not self.throttled:
+            return
+        with self.lock:
+            self.throttled = 0
+            if self.request_rate == self.max_request_rate:
+                return
+            rate = self.request_rate * RECOVERY_FACTOR
+            if self.max_request_rate:
+                rate = min(rate, self.max_request_rate)
+            elif rate > UNLIMITED_REQUEST_RATE:
+                rate = 0
+            self.set_request_rate(rate)
+
+    def set_request_rate(self, rate):
+        self.request_rate = rate
+        if not rate:
+            self.requests = None
+        elif self.requests is None:
+            self.requests = TokenBucket(rate)
+        else:
+            self.requests.set_rate(rate)
+
+    def current_rate(self):
+        '''
+        Requests per second over the last requests
+        '''
+        if len(self.sent) < 2:
+            return 0.0
+        elapsed = self.sent[-1] - self.sent[0]
+        return (len(self.sent) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def gauges(self):
+        with self.lock:
+            return {
+                'request_rate': self.current_rate(),
+                'request_rate_limit': self.request_rate
+            }
@@ -0,0 +1,78 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import threading
+
+from target_typo.logging import log_info
+
+
+# Import responses meaning that the batch was too large or the cluster is overloaded
+REJECTED_STATUSES = (413, 429, 500, 502, 503, 504)
+
+# Multiplicative decrease after a slow import and after a rejected one
+SLOW_FACTOR = 0.5
+REJECTED_FACTOR = 0.25
+
+
+class AdaptiveBatchSize():
+    '''
+    Number of records per batch of every dataset, adjusted with AIMD:
+    it grows by step records after every full batch imported within the target latency,
+    and is divided after a slow or rejected import.
+    '''
+
+    def __init__(self, initial, minimum, maximum, target_latency, step):
+        self.initial = min(max(initial, minimum), maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.step = step
+        self.lock = threading.Lock()
+        self.thresholds = {}
+
+    def threshold(self, dataset):
+        return self.thresholds.get(dataset, self.initial)
+
+    def observe(self, dataset, latency, records):
+        '''
+        Adjusts the batch size of a dataset after a successful import
+        '''
+        with self.lock:
+            current = self.threshold(dataset)
+            if latency > self.target_latency:
+                new = max(int(current * SLOW_FACTOR), self.minimum)
+            elif records >= current:
+                new = min(current + self.step, self.maximum)
+            else:
+                # Batch sent before being full, it says nothing about a larger size
+                return current
+            self.set_threshold(dataset, current, new, 'import took {} ms'.format(int(latency * 1000)))
+            return new
+
+    def reject(self, dataset, status):
+        '''
+        Reduces the batch size of a dataset after a rejected import
+        '''
+        with self.lock:
+            current = self.threshold(dataset)
+            new = max(int(current * REJECTED_FACTOR), self.minimum)
+            self.set_threshold(dataset, current, new, 'import returned status code {}'.format(status))
+            return new
+
+    def set_threshold(self, dataset, current, new, reason):
+        self.thresholds[dataset] = new
+        if new != current:
+            log_info('Dataset %s: batch size changed from %s to %s records, %s.', dataset, current, new, reason)
@@ -0,0 +1,236 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import os
+import re
+import threading
+import time
+
+from target_typo.batch import DatasetBuffer
+from target_typo.codec import dumps_bytes, dumps_text
+from target_typo.logging import log_info
+
+
+SEGMENT_FILE = re.compile(r'^segment-([0-9]+)\.jsonl$')
+# Last state emitted after all its records were acknowledged, and last state received from the tap
+STATE_FILE = 'state.json'
+PENDING_STATE_FILE = 'pending_state.json'
+# Minimum seconds between two writes of the last state received
+STATE_SYNC_INTERVAL = 1.0
+
+
+class SegmentRows():
+    '''
+    Encoded records of a sealed segment file, read line by line so that a request body streamed from them does not
+    hold the whole batch in memory
+    '''
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.path, 'rb') as segment:
+            next(segment)
+            for line in segment:
+                # A record partially written before a crash has no line ending and is skipped
+                if line.endswith(b'\n'):
+                    yield line[:-1]
+
+
+class SpoolSegment():
+    '''
+    Records of one dataset batch appended to a segment file instead of being kept in memory.
+    The first line of the file holds the dataset name, every other line is one record.
+    Rows are read back lazily from the file as the UTF-8 JSON encoding of the records.
+    '''
+    encoded = True
+
+    def __init__(self, codec, path, dataset, batch_number, count=0):
+        self.codec = codec
+        self.path = path
+        self.dataset = dataset
+        self.batch_number = batch_number
+        self.count = count
+        self.size = 0
+        # Bytes of the buffered bytes budget held by the batch
+        self.reserved = 0
+        self.since = time.monotonic()
+        self.file = None
+
+    def __len__(self):
+        return self.count
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(dumps_bytes(self.codec, {'dataset': self.dataset}) + b'\n')
+
+    def append(self, row, size=0):
+        '''
+        Adds a record, or its encoding
+        '''
+        self.file.write((row if isinstance(row, bytes) else dumps_bytes(self.codec, row)) + b'\n')
+        self.count += 1
+        self.size += size
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    @property
+    def rows(self):
+        '''
+        Encoded records read back from the segment file every time they are iterated
+        '''
+        return SegmentRows(self.path, self.count)
+
+    def records(self):
+        return [self.codec.loads(row.decode('utf-8')) for row in self.rows]
+
+    def part(self, rows):
+        part = DatasetBuffer(self.dataset, self.batch_number, self.codec)
+        part.rows = rows
+        return part
+
+
+class Spool():
+    '''
+    Directory of segment files holding the batches that have not been acknowledged by Typo yet
+    '''
+
+    def __init__(self, directory, codec):
+        self.directory = directory
+        self.codec = codec
+        self.segments = {}
+        # Last state received and not written to disk yet
+        self.pending = None
+        self.synced = None
+        # States are saved by the thread acknowledging a batch while the main thread adds records
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def open_segment(self, dataset, batch_number):
+        path = os.path.join(self.directory, 'segment-{:012d}.jsonl'.format(batch_number))
+        segment = SpoolSegment(self.codec, path, dataset, batch_number)
+        segment.open()
+        with self.lock:
+            self.segments[batch_number] = segment
+        return segment
+
+    def seal(self, segment):
+        '''
+        Writes the segment to disk before it is sent. No record is added after this.
+        '''
+        with self.lock:
+            self.segments.pop(segment.batch_number, None)
+            segment.close()
+
+    def remove(self, segment):
+        '''
+        Deletes an acknowledged segment
+        '''
+        try:
+            os.remove(segment.path)
+        except FileNotFoundError:
+            pass
+
+    def add_state(self, state):
+        '''
+        Keeps the last state received. It is written to disk at most every STATE_SYNC_INTERVAL seconds, or with the
+        next emitted state.
+        '''
+        with self.lock:
+            self.pending = state
+            if self.synced is None or time.monotonic() - self.synced >= STATE_SYNC_INTERVAL:
+                self.sync_pending()
+
+    def save_state(self, state):
+        '''
+        Keeps the last state emitted, and the last state received with the records before it. A run stopped before
+        they are written resumes from the previous ones, which at worst sends records again.
+        '''
+        with self.lock:
+            self.sync_pending()
+            self.write_state(STATE_FILE, state)
+
+    def sync_pending(self):
+        if self.pending is None:
+            return
+        for segment in self.segments.values():
+            segment.sync()
+        self.write_state(PENDING_STATE_FILE, self.pending)
+        self.pending = None
+        self.synced = time.monotonic()
+
+    def write_state(self, name, state):
+        path = os.path.join(self.directory, name)
+        temporary = path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as state_output:
+            state_output.write(dumps_text(self.codec, state))
+            state_output.flush()
+            os.fsync(state_output.fileno())
+        os.replace(temporary, path)
+
+    def read_state(self, name):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as state_input:
+            return self.codec.loads(state_input.read())
+
+    def recover(self):
+        '''
+        Returns the segments left by a previous run in batch order and the last state received by that run
+        '''
+        numbers = sorted(
+            int(match.group(1))
+            for match in (SEGMENT_FILE.match(name) for name in os.listdir(self.directory))
+            if match
+        )
+        segments = []
+        for number in numbers:
+            path = os.path.join(self.directory, 'segment-{:012d}.jsonl'.format(number))
+            with open(path, 'rb') as segment_input:
+                header = segment_input.readline()
+                if not header.endswith(b'\n'):
+                    # The segment was created right before a crash and holds no record
+                    os.remove(path)
+                    continue
+                count = sum(1 for line in segment_input if line.endswith(b'\n'))
+            dataset = self.codec.loads(header.decode('utf-8'))['dataset']
+            segments.append(SpoolSegment(self.codec, path, dataset, number, count))
+
+        if segments:
+            log_info('Found %s unacknowledged batches in spool directory %s.', len(segments), self.directory)
+        return segments, self.read_state(PENDING_STATE_FILE)
+
+    def close(self):
+        '''
+        Called once every state has been emitted
+        '''
+        path = os.path.join(self.directory, PENDING_STATE_FILE)
+        if os.path.exists(path):
+            os.remove(path)
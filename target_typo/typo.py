@@ -14,15 +14,42 @@
 #
 # This product includes software developed at or by Typo (https://www.typo.ai/).
 
+import numbers
 import sys
-import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
 
 import backoff
 
+from target_typo.auth import TokenManager
+from target_typo.batch import FORMAT_COLUMNS, FORMAT_RECORDS, BodyStream, DatasetBuffer, encode_batch, stream_batch
+from target_typo.codec import dumps_bytes, get_codec
+from target_typo.compression import COMPRESSION_NONE, compress, compress_chunks, resolve_compression
+from target_typo.constants import ENGINE_ASYNC
+from target_typo.deadletter import REJECTED_RECORDS_STATUSES, DeadLetterFile
 from target_typo.default_config import DEFAULTS
 from target_typo.logging import log_backoff, log_critical, log_debug, log_info
-from target_typo.utils import emit_state
+from target_typo.memory import MemoryBudget
+from target_typo.metrics import STAGE_HTTP, STAGE_SERIALIZE, Metrics
+from target_typo.pipeline import AckTracker, BatchUploader
+from target_typo.ratelimit import THROTTLED_MAX_TRIES, RateLimiter, parse_retry_after
+from target_typo.sizing import REJECTED_STATUSES, AdaptiveBatchSize
+from target_typo.spool import Spool
+
+
+def count_retry(details):
+    '''
+    Counts the network errors retried by backoff in the metrics of the dataset
+    '''
+    target = details['args'][0]
+    dataset = details['kwargs'].get('dataset')
+    if target.metrics is not None and dataset is not None:
+        target.metrics.add_retry(dataset)
+
+
+# Attempts of a rejected batch that cannot be split anymore
+REJECTED_MAX_TRIES = 8
 
 
 # pylint: disable=unused-argument
@@ -46,40 +73,227 @@ class TypoTarget():
         self.api_secret = config['api_secret']
         self.repository = config['repository']
         self.send_threshold = config['send_threshold'] if 'send_threshold' in config else DEFAULTS['send_threshold']
+        self.payload_format = config.get('payload_format', DEFAULTS['payload_format'])
+        # Records are encoded when they are buffered and request bodies are produced in chunks
+        self.stream_body = config.get('stream_body', DEFAULTS['stream_body'])
+        self.codec = get_codec(config.get('json_codec', DEFAULTS['json_codec']))
         self.retry_bool = False
-        self.token = ''
-        self.data_out = []
+        self.tokens = TokenManager(
+            self.request_token_lifetime,
+            config.get('token_lifetime_s', DEFAULTS['token_lifetime_s']),
+            config.get('token_refresh_margin_s', DEFAULTS['token_refresh_margin_s'])
+        )
+        self.buffers = {}
         self.batch_number = 0
-        self.state = None
+
+        # Per stage timers and per stream counters, logged as Singer metrics and written to a summary file
+        self.metrics = None
+        metrics_interval = config.get('metrics_interval_s', DEFAULTS['metrics_interval_s'])
+        if metrics_interval or config.get('metrics_file'):
+            self.metrics = Metrics(metrics_interval, config.get('metrics_file'))
+
+        # Optional disk spool keeping unacknowledged batches and the last states, to resume after a crash
+        self.spool = None
+        if config.get('spool_dir'):
+            self.spool = Spool(config['spool_dir'], self.codec)
+        # STATE messages are coalesced and emitted every state_interval_ms or state_interval_records
+        self.tracker = AckTracker(
+            on_emit=self.spool.save_state if self.spool is not None else None,
+            metrics=self.metrics,
+            interval=config.get('state_interval_ms', DEFAULTS['state_interval_ms']) / 1000,
+            records_interval=config.get('state_interval_records', DEFAULTS['state_interval_records'])
+        )
+
+        # Additional flush triggers: serialized size of the batch, time since its first record, and time a STATE
+        # has been waiting for the batch
+        self.max_batch_bytes = config.get('max_batch_bytes', DEFAULTS['max_batch_bytes'])
+        self.linger = config.get('linger_ms', DEFAULTS['linger_ms']) / 1000
+        self.max_state_delay = config.get('max_state_delay_ms', DEFAULTS['max_state_delay_ms']) / 1000
+
+        # Keep-alive connection pool shared by the token and import requests
+        self.timeout = (
+            config.get('connect_timeout', DEFAULTS['connect_timeout']),
+            config.get('read_timeout', DEFAULTS['read_timeout'])
+        )
+        self.engine = config.get('engine', DEFAULTS['engine'])
+        pool_size = config.get('http_pool_size', DEFAULTS['http_pool_size'])
+        if self.engine == ENGINE_ASYNC:
+            # Every concurrent import request keeps its connection open
+            pool_size = max(pool_size, config.get('async_concurrency', DEFAULTS['async_concurrency']))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Rate of the requests to Typo, shared by the token and import requests of every sender thread
+        self.limiter = RateLimiter(
+            config.get('max_requests_per_second', DEFAULTS['max_requests_per_second']),
+            config.get('max_bytes_per_second', DEFAULTS['max_bytes_per_second'])
+        )
+        if self.metrics is not None:
+            self.metrics.gauge_sources.append(self.limiter.gauges)
+
+        # Adaptive mode: the number of records per batch of every dataset follows the import latency
+        self.sizer = None
+        if config.get('adaptive_batching', DEFAULTS['adaptive_batching']):
+            self.sizer = AdaptiveBatchSize(
+                self.send_threshold,
+                config.get('min_send_threshold', DEFAULTS['min_send_threshold']),
+                config.get('max_send_threshold', DEFAULTS['max_send_threshold']),
+                config.get('target_latency_ms', DEFAULTS['target_latency_ms']) / 1000,
+                config.get('send_threshold_step', DEFAULTS['send_threshold_step'])
+            )
+
+        # Records rejected by Typo are isolated and written to the dead letter file instead of stopping the target
+        self.dead_letters = None
+        if config.get('dead_letter_file'):
+            self.dead_letters = DeadLetterFile(config['dead_letter_file'], self.codec)
+
+        # Import responses handled by send_part
+        self.retried_statuses = ()
+        if self.sizer is not None:
+            self.retried_statuses += REJECTED_STATUSES
+        if self.dead_letters is not None:
+            self.retried_statuses += REJECTED_RECORDS_STATUSES
+
+        # Import payload compression
+        self.compression = resolve_compression(config.get('compression', DEFAULTS['compression']))
+        self.compression_level = config.get('compression_level')
+        if self.compression != config.get('compression', DEFAULTS['compression']):
+            # The level of the configured compressor may not be accepted by the fallback
+            self.compression_level = None
+        self.compression_min_bytes = config.get('compression_min_bytes', DEFAULTS['compression_min_bytes'])
+
+        # Deduplication: rows with the key properties of a buffered row replace it
+        self.deduplicate = config.get('deduplicate', DEFAULTS['deduplicate'])
+        self.key_properties = {}
+        self.collapsed = {}
+
+        # Bytes of the records buffered, queued and being sent. Reading the input waits while it is used up.
+        self.budget = None
+        max_buffered_bytes = config.get('max_buffered_bytes', DEFAULTS['max_buffered_bytes'])
+        if max_buffered_bytes:
+            self.budget = MemoryBudget(max_buffered_bytes)
+            if self.metrics is not None:
+                self.metrics.gauge_sources.append(self.budget.gauges)
+        # Whether a record waits for the budget when it is used up. The async engine waits on its own instead.
+        self.wait_for_budget = True
+
+        # Records are encoded once when they are buffered, either to be streamed or because their size is measured.
+        # Rows of the columns format are kept decoded to build the columns.
+        self.encode_rows = self.stream_body or (
+            bool(self.max_batch_bytes or self.budget is not None) and self.payload_format != FORMAT_COLUMNS
+        )
+        # Size of the properties around the records of each dataset in the records format
+        self.overheads = {}
+
+        # Pipelined mode: batches are sent by background workers while stdin keeps being processed.
+        # The async engine sets its own uploader while it runs.
+        upload_workers = config.get('upload_workers', DEFAULTS['upload_workers'])
+        self.uploader = None
+        if upload_workers > 0 and self.engine != ENGINE_ASYNC:
+            self.uploader = BatchUploader(
+                self.send_batch,
+                upload_workers,
+                config.get('upload_queue_size', DEFAULTS['upload_queue_size'])
+            )
 
     @backoff.on_exception(
         backoff.expo,
         (requests.exceptions.Timeout, requests.exceptions.ConnectionError),
         max_tries=8,
-        on_backoff=log_backoff,
+        on_backoff=[log_backoff, count_retry],
         on_giveup=backoff_giveup,
         logger=None,
         factor=3
     )
-    def post_request(self, url, headers, payload):
+    def post_request(self, url, headers, payload, compressed=False, accepted_statuses=(), dataset=None, records=0):
         '''
-        Generic POST request
+        Generic POST request. Responses with one of accepted_statuses are returned to the caller instead of failing.
+        dataset and records of import requests are only used for the metrics.
         '''
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        status = response.status_code
+        started = time.perf_counter()
+        body = payload if isinstance(payload, (BodyStream, bytes)) else self.codec.dumps(payload)
+        if compressed:
+            body, headers = self.compress_body(body, headers)
+        if self.metrics is not None:
+            self.metrics.add_time(STAGE_SERIALIZE, time.perf_counter() - started)
+
+        for _ in range(THROTTLED_MAX_TRIES):
+            self.limiter.acquire(len(body))
+            sent = time.perf_counter()
+            response = self.session.post(url, headers=headers, data=body, timeout=self.timeout)
+            status = response.status_code
+            received = time.perf_counter()
+
+            if self.metrics is not None:
+                self.metrics.add_time(STAGE_HTTP, received - sent)
+
+            if status != 429:
+                self.limiter.success()
+                break
+
+            # Too many requests, every sender waits before trying again
+            if self.metrics is not None and dataset is not None:
+                self.metrics.add_retry(dataset)
+            self.limiter.throttle(parse_retry_after(response.headers.get('Retry-After')))
+
+        if self.metrics is not None and status == 200 and dataset is not None:
+            self.metrics.add_import(dataset, records, len(body), received - sent)
 
         if status == 200:
             data = response.json()
             return status, data
 
+        if status in accepted_statuses:
+            try:
+                return status, response.json()
+            except ValueError:
+                return status, {'message': response.text}
+
         log_critical('Request to URL %s returned status code %s. Please check your configuration and try again later.',
                      url, status)
         sys.exit(1)
 
+    def compress_body(self, body, headers):
+        '''
+        Compresses the request body when it is large enough to be worth it
+        '''
+        if self.compression == COMPRESSION_NONE:
+            return body, headers
+
+        raw = body.encode('utf-8') if isinstance(body, str) else body
+        if len(raw) < self.compression_min_bytes:
+            return body, headers
+
+        if isinstance(raw, BodyStream):
+            compressed_body = compress_chunks(raw, self.compression, self.compression_level)
+        else:
+            compressed_body = compress(raw, self.compression, self.compression_level)
+        log_info('Compressed request body with %s from %s to %s bytes (ratio %.1f).', self.compression, len(raw),
+                 len(compressed_body), len(raw) / max(len(compressed_body), 1))
+
+        headers = dict(headers, **{'Content-Encoding': self.compression})
+        return compressed_body, headers
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    @token.setter
+    def token(self, token):
+        self.tokens.set_token(token)
+
     def request_token(self):
         '''
         Token Request for other requests
         '''
+        return self.request_token_lifetime()[0]
+
+    def request_token_lifetime(self):
+        '''
+        Requests a token. Returns the token and its lifetime in seconds if the response has one.
+        '''
         # Required parameters
         url = self.base_url.rstrip('/') + '/token'
         headers = {
@@ -103,49 +317,247 @@ class TypoTarget():
             log_critical('%s Details: %s', error_message, data)
             sys.exit(1)
 
-        return data['token']
+        lifetime = data.get('expires_in')
+        return data['token'], lifetime if isinstance(lifetime, numbers.Number) else None
 
     def enqueue_to_dataset(self, dataset, line):
         '''
-        Constructing dataset for POST Request
+        Adds a record to the buffer of its dataset
         '''
-        data = {
-            'repository': self.repository,
-            'dataset': dataset,
-            'data': line
-        }
-        self.data_out.append(data)
+        key = None
+        if self.deduplicate and self.key_properties.get(dataset):
+            key = tuple(line.get(name) for name in self.key_properties[dataset])
+            if None in key:
+                key = None
+
+        if self.encode_rows:
+            # The record is encoded once, and sent without being encoded again
+            line = dumps_bytes(self.codec, line)
 
-        # Submitting a post request every configured number of records in dataset
-        if len(self.data_out) == self.send_threshold:
-            self.import_dataset(self.data_out)
+        size = 0
+        if self.max_batch_bytes or self.budget is not None:
+            # Serialized size plus the ", " separator
+            size = len(line if self.encode_rows else self.codec.dumps(line)) + 2
+            if self.payload_format == FORMAT_RECORDS:
+                size += self.record_overhead(dataset)
+            if self.budget is not None:
+                self.reserve(size)
 
-        return data
+        batch = self.buffers.get(dataset)
+        if self.max_batch_bytes and batch is not None and batch.size + size > self.max_batch_bytes:
+            self.flush_dataset(dataset)
+            batch = None
 
-    def import_dataset(self, datasets):
+        if batch is None:
+            batch = self.open_batch(dataset)
+
+        previous = batch.index.get(key) if key is not None and batch.index is not None else None
+        if previous is not None:
+            # Only the last version of the row is sent, in the position of the first one
+            position, previous_size = previous
+            batch.rows[position] = line
+            batch.size += size - previous_size
+            batch.index[key] = (position, size)
+            self.collapsed[dataset] = self.collapsed.get(dataset, 0) + 1
+            if self.budget is not None:
+                self.budget.release(previous_size)
+                batch.reserved -= previous_size
+        else:
+            if key is not None and batch.index is not None:
+                batch.index[key] = (len(batch), size)
+            batch.append(line, size)
+        if self.budget is not None:
+            batch.reserved += size
+
+        threshold = self.send_threshold if self.sizer is None else self.sizer.threshold(dataset)
+
+        # Submitting a post request every configured number of records in dataset or when the batch is full
+        if len(batch) >= threshold or (self.max_batch_bytes and batch.size >= self.max_batch_bytes):
+            self.flush_dataset(dataset)
+
+    def reserve(self, size):
         '''
-        Push Dataset to Typo via POST Request
+        Reserves the budget of a record. When it is used up, the largest buffers are sent if they hold a large share
+        of it, then reading the input waits until enough batches have been acknowledged.
+        '''
+        if self.budget.try_acquire(size):
+            return
+
+        self.flush_for_budget(size)
+        if self.budget.try_acquire(size):
+            return
+
+        if self.wait_for_budget:
+            self.budget.acquire(size, self.uploader.raise_error if self.uploader is not None else None)
+        else:
+            # The async engine waits for the budget without blocking its event loop
+            self.budget.force(size)
+
+    def flush_for_budget(self, size):
+        '''
+        Sends the largest buffers while they hold half of the budget or more, or while a record of size bytes
+        cannot fit next to them. Smaller buffers keep filling while the batches being sent release the budget.
+        '''
+        open_bytes = sum(batch.reserved for batch in self.buffers.values())
+        for dataset in sorted(self.buffers, key=lambda name: self.buffers[name].reserved, reverse=True):
+            if open_bytes * 2 < self.budget.max_bytes and open_bytes + size <= self.budget.max_bytes:
+                return
+            open_bytes -= self.buffers[dataset].reserved
+            self.flush_dataset(dataset)
+
+    def open_batch(self, dataset):
+        '''
+        Creates the buffer of a dataset. Its batch number is reserved now so that states received later wait for it.
         '''
         self.batch_number += 1
+        self.tracker.submit(self.batch_number)
+        if self.spool is not None:
+            batch = self.spool.open_segment(dataset, self.batch_number)
+        else:
+            batch = DatasetBuffer(dataset, self.batch_number, self.codec if self.encode_rows else None)
+        if self.deduplicate and self.key_properties.get(dataset):
+            batch.index = {}
+        if self.max_batch_bytes and self.payload_format != FORMAT_RECORDS:
+            # Header of the payload, minus the separator counted for the last record
+            batch.size = len(self.codec.dumps(encode_batch(self.repository, batch, self.payload_format))) - 2
+        self.buffers[dataset] = batch
+        return batch
+
+    def set_key_properties(self, dataset, key_properties):
+        '''
+        Key properties of a stream, from its SCHEMA message
+        '''
+        self.key_properties[dataset] = list(key_properties or [])
+
+    def record_overhead(self, dataset):
+        '''
+        Size of the repository and dataset properties repeated on every record of the records format
+        '''
+        if dataset not in self.overheads:
+            wrapper = {
+                'repository': self.repository,
+                'dataset': dataset,
+                'data': None
+            }
+            self.overheads[dataset] = len(self.codec.dumps(wrapper)) - len('null')
+        return self.overheads[dataset]
+
+    def check_linger(self):
+        '''
+        Sends the buffers whose oldest record has waited longer than linger_ms
+        '''
+        if not self.linger or not self.buffers:
+            return
 
+        now = time.monotonic()
+        for dataset in [dataset for dataset, batch in self.buffers.items() if now - batch.since >= self.linger]:
+            log_debug('Sending dataset %s after waiting %s ms.', dataset, int(self.linger * 1000))
+            self.flush_dataset(dataset)
+
+    def check_state_delay(self):
+        '''
+        Sends the buffers the oldest pending STATE waits for once it has waited longer than max_state_delay_ms, so
+        that streams that rarely reach send_threshold do not hold back the states of the others
+        '''
+        pending = self.tracker.oldest_pending()
+        if pending is None or not self.max_state_delay:
+            return
+
+        batch_number, received = pending
+        if time.monotonic() - received < self.max_state_delay:
+            return
+        for dataset in [dataset for dataset, batch in self.buffers.items() if batch.batch_number <= batch_number]:
+            log_debug('Sending dataset %s, a STATE has waited for it for %s ms.', dataset,
+                      int(self.max_state_delay * 1000))
+            self.flush_dataset(dataset)
+
+    def flush_dataset(self, dataset):
+        '''
+        Sends the buffered records of a dataset
+        '''
+        batch = self.buffers.pop(dataset, None)
+        if batch is not None:
+            if self.spool is not None:
+                self.spool.seal(batch)
+            self.import_dataset(batch)
+
+    def import_dataset(self, batch):
+        '''
+        Push Dataset to Typo via POST Request
+        '''
+        if self.uploader is not None:
+            # Let the workers send the batch
+            self.uploader.submit(batch)
+            return
+
+        self.send_batch(batch)
+
+    def send_batch(self, batch):
+        '''
+        Sends one batch to the import endpoint
+        '''
         # Required parameters
         url = self.base_url.rstrip('/') + '/import'
         headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.token  # self.access_token
+            'Content-Type': 'application/json'
         }
 
-        log_info('Batch %s: Sending %s records to Typo.', self.batch_number, len(datasets))
+        log_info('Batch %s: Sending %s records to Typo.', batch.batch_number, len(batch))
+
+        try:
+            if self.retried_statuses:
+                rejected = self.send_part(url, headers, batch)
+                if rejected and rejected == len(batch):
+                    # The cluster refuses the whole batch, the state must not move past it
+                    log_critical('Typo rejected every record of batch %s. Please check your configuration and the '
+                                 'file %s.', batch.batch_number, self.dead_letters.path)
+                    sys.exit(1)
+            else:
+                self.post_batch(url, headers, batch)
+
+            if self.spool is not None:
+                self.spool.remove(batch)
+            self.tracker.ack(batch.batch_number, len(batch))
+        finally:
+            # Also released when the batch fails, so that a reader waiting for the budget sees the error
+            if self.budget is not None:
+                self.budget.release(batch.reserved)
 
-        # POST Request
-        status, data = self.post_request(url, headers, datasets)
+    def post_batch(self, url, headers, batch, accepted_statuses=()):
+        '''
+        POST request of a batch. Returns the status code and the response.
+        '''
+        # The columns format needs every row to build each column, it is not streamed
+        if self.stream_body and self.payload_format != FORMAT_COLUMNS:
+            payload = stream_batch(self.repository, batch, self.payload_format, self.codec)
+        elif batch.encoded and self.payload_format != FORMAT_COLUMNS:
+            # Rows encoded when they were buffered or spooled are joined without being encoded again
+            payload = b''.join(stream_batch(self.repository, batch, self.payload_format, self.codec))
+        else:
+            payload = encode_batch(self.repository, batch, self.payload_format)
 
-        # Expired token
-        if status == 401:
-            log_debug('Token expired. Requesting new token.')
-            self.token = self.request_token()
-            # Retry post_request with new token
-            status, data = self.post_request(url, headers, datasets)
+        for attempt in range(2):
+            token = self.tokens.get()
+            # POST Request
+            status, data = self.post_request(url, dict(headers, Authorization='Bearer ' + token), payload,
+                                             compressed=True, accepted_statuses=accepted_statuses + (401,),
+                                             dataset=batch.dataset, records=len(batch))
+            if status != 401:
+                break
+
+            # Expired token, retry once with a new one
+            if attempt == 0:
+                log_debug('Token expired. Requesting new token.')
+                if self.metrics is not None:
+                    self.metrics.add_retry(batch.dataset)
+                self.tokens.invalidate(token)
+        else:
+            log_critical('Request to URL %s returned status code 401 with a new token. Please check your '
+                         'configuration and try again later.', url)
+            sys.exit(1)
+
+        if status in accepted_statuses:
+            return status, data
 
         # Check Status
         good_status = [200, 201, 202]
@@ -153,14 +565,148 @@ class TypoTarget():
             log_critical('Request failed. Please try again later. %s', data['message'])
             sys.exit(1)
 
-        # Reset data_out
-        self.data_out = []
-        self.emit_state()
+        return status, data
+
+    def send_part(self, url, headers, batch, attempt=0):
+        '''
+        Sends a batch, or part of it, handling the responses of retried_statuses.
+        In adaptive mode the batch size of the dataset is adjusted, and a batch rejected because of its size or the
+        load of the cluster is split to the new batch size, or sent again after a pause once it cannot be split.
+        Batches with rejected records are split in halves until each rejected record is written to the dead letter
+        file. Returns the number of records written to it.
+        '''
+        started = time.perf_counter()
+        status, data = self.post_batch(url, headers, batch, self.retried_statuses)
+
+        if status not in self.retried_statuses:
+            if self.sizer is not None:
+                self.sizer.observe(batch.dataset, time.perf_counter() - started, len(batch))
+            return 0
+
+        if self.metrics is not None:
+            self.metrics.add_retry(batch.dataset)
+        # Rows of a spooled batch are read from its file to be split
+        rows = list(batch.rows)
 
-    def emit_state(self):
-        if self.state is not None:
-            emit_state(self.state)
-            self.state = None
+        if self.sizer is not None and status in REJECTED_STATUSES:
+            threshold = self.sizer.reject(batch.dataset, status)
+            if len(rows) > threshold:
+                return self.send_parts(url, headers, batch, rows, threshold)
+
+            if self.dead_letters is None or status not in REJECTED_RECORDS_STATUSES:
+                if attempt + 1 >= REJECTED_MAX_TRIES:
+                    log_critical('Request failed with status code %s after %s attempts. Please try again later.',
+                                 status, REJECTED_MAX_TRIES)
+                    sys.exit(1)
+
+                wait = min(2 ** attempt, 60)
+                log_info('Batch %s: Import returned status code %s. Sleeping %s seconds before trying again.',
+                         batch.batch_number, status, wait)
+                time.sleep(wait)
+                return self.send_part(url, headers, batch, attempt + 1)
+
+        if len(rows) == 1:
+            self.dead_letters.write(batch.dataset, batch.records()[0], status, data)
+            return 1
+
+        log_info('Batch %s: Import of %s records returned status code %s. Sending them in two parts.',
+                 batch.batch_number, len(rows), status)
+        return self.send_parts(url, headers, batch, rows, (len(rows) + 1) // 2)
+
+    def send_parts(self, url, headers, batch, rows, size):
+        '''
+        Sends the rows of a batch in parts of size records. Returns the number of rejected records.
+        '''
+        return sum(
+            self.send_part(url, headers, batch.part(rows[start:start + size]))
+            for start in range(0, len(rows), size)
+        )
+
+    def resume(self):
+        '''
+        Sends the batches left in the spool by a previous run, then emits the last state that run received
+        '''
+        if self.spool is None:
+            return
+
+        segments, state = self.spool.recover()
+        for segment in segments:
+            # Batches are numbered again after the ones of this run
+            self.batch_number += 1
+            self.tracker.submit(self.batch_number)
+            segment.batch_number = self.batch_number
+            log_info('Resuming spooled batch of dataset %s with %s records.', segment.dataset, len(segment))
+            self.send_batch(segment)
+
+        if state is not None:
+            self.tracker.add_state(state)
+        # The state of the previous run is emitted before its pending state file is removed
+        self.tracker.close()
+        self.spool.close()
+
+    @property
+    def data_out(self):
+        '''
+        Buffered records in the records payload format
+        '''
+        return [
+            record
+            for batch in self.buffers.values()
+            for record in encode_batch(self.repository, batch, FORMAT_RECORDS)
+        ]
+
+    def flush(self):
+        '''
+        Sends the remaining records and waits for every pending batch
+        '''
+        for dataset in list(self.buffers):
+            self.flush_dataset(dataset)
+
+        if self.uploader is not None:
+            self.uploader.close()
+            self.uploader = None
+
+        self.tracker.close()
+
+        if self.spool is not None:
+            self.spool.close()
+
+        if self.dead_letters is not None:
+            self.dead_letters.close()
+
+        for dataset, collapsed in sorted(self.collapsed.items()):
+            log_info('Stream %s: %s rows replaced by a later version with the same key properties.', dataset,
+                     collapsed)
+            if self.metrics is not None:
+                self.metrics.set_counters(dataset, {'collapsed': collapsed})
+
+        if self.metrics is not None:
+            self.metrics.close()
+
+        opened, reused = self.connection_stats()
+        log_info('HTTP connections opened: %s, reused: %s.', opened, reused)
+
+    def connection_stats(self):
+        '''
+        Returns the number of connections opened and reused by the session
+        '''
+        opened = 0
+        sent = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    sent += pool.num_requests
+        return opened, max(sent - opened, 0)
 
     def set_state(self, state):
-        self.state = state
+        '''
+        Keeps the state until the records received before it have been sent
+        '''
+        if self.uploader is not None:
+            self.uploader.raise_error()
+        if self.spool is not None:
+            self.spool.add_state(state)
+        self.tracker.add_state(state)
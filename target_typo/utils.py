@@ -14,26 +14,143 @@
 #
 # This product includes software developed at or by Typo (https://www.typo.ai/).
 
-import collections
+import collections.abc
+import functools
 import json
 import sys
 
 
-def flatten(data_json, parent_key='', sep='__'):
+# Types of the values parsed from JSON that can never be nested objects
+SCALAR_TYPES = frozenset([str, int, float, bool, list, type(None)])
+
+
+class KeyCache():
+    '''
+    Flattened keys by parent key and property name, with least recently used eviction past maxsize entries.
+    Keys are interned, so the rows of a stream share the same key strings.
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.keys = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def join(self, parent_key, name, sep='__'):
+        cache_key = (parent_key, name)
+        new_key = self.keys.get(cache_key)
+        if new_key is not None:
+            self.hits += 1
+            self.keys.move_to_end(cache_key)
+            return new_key
+
+        self.misses += 1
+        new_key = sys.intern(parent_key + sep + name if parent_key else name)
+        self.keys[cache_key] = new_key
+        if len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+        return new_key
+
+
+def flatten(data_json, parent_key='', sep='__', cache=None):
     '''
     Flattening JSON nested file
     *Singer default template function
     '''
     items = []
     for json_object, json_value in data_json.items():
-        new_key = parent_key + sep + json_object if parent_key else json_object
-        if isinstance(json_value, collections.MutableMapping):
-            items.extend(flatten(json_value, new_key, sep=sep).items())
+        if cache is not None:
+            new_key = cache.join(parent_key, json_object, sep)
+        else:
+            new_key = parent_key + sep + json_object if parent_key else json_object
+        if isinstance(json_value, collections.abc.MutableMapping):
+            items.extend(flatten(json_value, new_key, sep=sep, cache=cache).items())
         else:
             items.append((new_key, str(json_value) if isinstance(json_value, list) else json_value))
     return dict(items)
 
 
+def schema_properties(schema):
+    '''
+    Properties of an object schema, including the ones declared in anyOf, oneOf and allOf branches
+    '''
+    if not isinstance(schema, dict):
+        return {}
+
+    properties = {}
+    for keyword in ('anyOf', 'oneOf', 'allOf'):
+        for subschema in schema.get(keyword, []):
+            properties.update(schema_properties(subschema))
+    if isinstance(schema.get('properties'), dict):
+        properties.update(schema['properties'])
+    return properties
+
+
+def build_flatten_plan(schema, parent_key='', sep='__'):
+    '''
+    Precomputes the flattened key of every property declared in a schema.
+    Each entry maps a property name to its output key and the plan of its nested properties, if any.
+    '''
+    plan = {}
+    for name, subschema in schema_properties(schema).items():
+        new_key = parent_key + sep + name if parent_key else name
+        plan[name] = (new_key, build_flatten_plan(subschema, new_key, sep=sep) or None)
+    return plan
+
+
+def flatten_with_plan(data_json, plan, sep='__', cache=None):
+    '''
+    Iterative version of flatten using the keys precomputed by build_flatten_plan.
+    Keys missing from the plan are joined like flatten does, through cache if given. Values are still checked, so
+    records that do not match their schema are flattened exactly like flatten would.
+    '''
+    flattened = {}
+    stack = [(iter(data_json.items()), plan, '')]
+    while stack:
+        items, items_plan, parent_key = stack[-1]
+        for json_object, json_value in items:
+            entry = items_plan.get(json_object) if items_plan is not None else None
+            if entry is None:
+                if cache is not None:
+                    new_key = cache.join(parent_key, json_object, sep)
+                else:
+                    new_key = parent_key + sep + json_object if parent_key else json_object
+                sub_plan = None
+            else:
+                new_key, sub_plan = entry
+
+            if isinstance(json_value, dict) or (json_value.__class__ not in SCALAR_TYPES and
+                                                isinstance(json_value, collections.abc.MutableMapping)):
+                # Continue with the nested object, this level is resumed afterwards
+                stack.append((iter(json_value.items()), sub_plan, new_key))
+                break
+            flattened[new_key] = str(json_value) if isinstance(json_value, list) else json_value
+        else:
+            stack.pop()
+    return flattened
+
+
+@functools.lru_cache(maxsize=None)
+def get_version():
+    '''
+    Returns the installed version of target-typo, resolved once
+    '''
+    try:
+        from importlib.metadata import PackageNotFoundError, version  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources  # pylint: disable=import-outside-toplevel
+        try:
+            return pkg_resources.get_distribution('target-typo').version
+        except pkg_resources.DistributionNotFound:
+            return 'unknown'
+
+    try:
+        return version('target-typo')
+    except PackageNotFoundError:
+        return 'unknown'
+
+
 def emit_state(state):
     if state is not None:
         line = json.dumps(state)
@@ -0,0 +1,369 @@
+# Copyright 2019-2020 Typo. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# This product includes software developed at or by Typo (https://www.typo.ai/).
+
+import hashlib
+import json
+import numbers
+import re
+import threading
+import zlib
+
+from target_typo.logging import log_debug
+
+
+# Records validated: all of them, the first validation_n of each stream, about 1 in validation_n, or none
+VALIDATION_FULL = 'full'
+VALIDATION_FIRST_N = 'first_n'
+VALIDATION_SAMPLE = 'sample'
+VALIDATION_OFF = 'off'
+VALIDATION_MODES = [VALIDATION_FULL, VALIDATION_FIRST_N, VALIDATION_SAMPLE, VALIDATION_OFF]
+
+# Maximum indentation of inlined checks. Deeper subschemas are compiled into their own functions.
+MAX_INLINE_DEPTH = 12
+
+TYPE_CHECKS = {
+    'array': 'isinstance({0}, list)',
+    'boolean': 'isinstance({0}, bool)',
+    'integer': '(isinstance({0}, int) and not isinstance({0}, bool))',
+    'null': '{0} is None',
+    'number': '(isinstance({0}, Number) and not isinstance({0}, bool))',
+    'object': 'isinstance({0}, dict)',
+    'string': 'isinstance({0}, str)',
+}
+
+
+def ensure_list(value):
+    return [value] if isinstance(value, str) else value
+
+
+class UnsupportedSchema(Exception):
+    '''
+    Raised for schemas the compiler cannot turn into code. They are validated by Draft4Validator.
+    '''
+
+
+class SchemaCompiler():
+    '''
+    Generates a Python function returning whether an instance is valid, with the semantics of Draft4Validator
+    without format checker
+    '''
+
+    def __init__(self):
+        self.namespace = {
+            'Number': numbers.Number,
+        }
+        self.functions = []
+        self.counter = 0
+
+    def compile(self, schema):
+        name = self.function(schema)
+        source = '\n\n'.join(self.functions)
+        exec(compile(source, '<schema>', 'exec'), self.namespace)  # pylint: disable=W0122
+        return self.namespace[name]
+
+    def name(self, prefix):
+        self.counter += 1
+        return '{}{}'.format(prefix, self.counter)
+
+    def constant(self, value):
+        name = self.name('c')
+        self.namespace[name] = value
+        return name
+
+    def function(self, schema):
+        name = self.name('validate_')
+        lines = ['def {}(data):'.format(name)]
+        self.generate(schema, 'data', lines, 1)
+        lines.append('    return True')
+        self.functions.append('\n'.join(lines))
+        return name
+
+    def check(self, schema, var, lines, depth):
+        '''
+        Validates var against a subschema, inline or through a function when nested too deep
+        '''
+        if depth < MAX_INLINE_DEPTH:
+            count = len(lines)
+            self.generate(schema, var, lines, depth)
+            if len(lines) == count:
+                lines.append('{}pass'.format('    ' * depth))
+        else:
+            lines.append('{}if not {}({}):'.format('    ' * depth, self.function(schema), var))
+            lines.append('{}    return False'.format('    ' * depth))
+
+    def generate(self, schema, var, lines, depth):  # pylint: disable=too-many-statements,too-many-locals
+        indent = '    ' * depth
+
+        def emit(line, extra=0):
+            lines.append(indent + '    ' * extra + line)
+
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema('Schema must be an object')
+        if '$ref' in schema:
+            raise UnsupportedSchema('$ref')
+
+        is_object = TYPE_CHECKS['object'].format(var)
+        is_array = TYPE_CHECKS['array'].format(var)
+        is_string = TYPE_CHECKS['string'].format(var)
+        is_number = TYPE_CHECKS['number'].format(var)
+
+        if 'type' in schema:
+            types = ensure_list(schema['type'])
+            if not types or any(not isinstance(name, str) or name not in TYPE_CHECKS for name in types):
+                raise UnsupportedSchema('type {!r}'.format(schema['type']))
+            emit('if not ({}):'.format(' or '.join(TYPE_CHECKS[name].format(var) for name in types)))
+            emit('return False', 1)
+
+        if 'enum' in schema:
+            emit('if {} not in {}:'.format(var, self.constant(schema['enum'])))
+            emit('return False', 1)
+
+        # Objects
+        if schema.get('required'):
+            emit('if {}:'.format(is_object))
+            for name in schema['required']:
+                emit('if {} not in {}:'.format(self.constant(name), var), 1)
+                emit('return False', 2)
+
+        for keyword, operator in (('minProperties', '<'), ('maxProperties', '>')):
+            if keyword in schema:
+                emit('if {} and len({}) {} {}:'.format(is_object, var, operator, self.constant(schema[keyword])))
+                emit('return False', 1)
+
+        if 'properties' in schema and schema['properties']:
+            emit('if {}:'.format(is_object))
+            for name, subschema in schema['properties'].items():
+                value = self.name('v')
+                key = self.constant(name)
+                emit('if {} in {}:'.format(key, var), 1)
+                emit('{} = {}[{}]'.format(value, var, key), 2)
+                self.check(subschema, value, lines, depth + 2)
+
+        if schema.get('patternProperties'):
+            emit('if {}:'.format(is_object))
+            for pattern, subschema in schema['patternProperties'].items():
+                key = self.name('k')
+                value = self.name('v')
+                emit('for {}, {} in {}.items():'.format(key, value, var), 1)
+                emit('if {}({}):'.format(self.constant(re.compile(pattern).search), key), 2)
+                self.check(subschema, value, lines, depth + 3)
+
+        if 'additionalProperties' in schema:
+            additional = schema['additionalProperties']
+            properties = self.constant(set(schema.get('properties', {})))
+            patterns = '|'.join(schema.get('patternProperties', {}))
+            key = self.name('k')
+            extra = '{} not in {}'.format(key, properties)
+            if patterns:
+                extra += ' and not {}({})'.format(self.constant(re.compile(patterns).search), key)
+            if isinstance(additional, dict):
+                emit('if {}:'.format(is_object))
+                emit('for {} in {}:'.format(key, var), 1)
+                emit('if {}:'.format(extra), 2)
+                self.check(additional, '{}[{}]'.format(var, key), lines, depth + 3)
+            elif not additional:
+                emit('if {}:'.format(is_object))
+                emit('for {} in {}:'.format(key, var), 1)
+                emit('if {}:'.format(extra), 2)
+                emit('return False', 3)
+
+        if schema.get('dependencies'):
+            emit('if {}:'.format(is_object))
+            for name, dependency in schema['dependencies'].items():
+                emit('if {} in {}:'.format(self.constant(name), var), 1)
+                if isinstance(dependency, dict):
+                    self.check(dependency, var, lines, depth + 2)
+                else:
+                    for required in ensure_list(dependency):
+                        emit('if {} not in {}:'.format(self.constant(required), var), 2)
+                        emit('return False', 3)
+                    emit('pass', 2)
+
+        # Arrays
+        for keyword, operator in (('minItems', '<'), ('maxItems', '>')):
+            if keyword in schema:
+                emit('if {} and len({}) {} {}:'.format(is_array, var, operator, self.constant(schema[keyword])))
+                emit('return False', 1)
+
+        if schema.get('uniqueItems'):
+            if 'uniq' not in self.namespace:
+                from jsonschema._utils import uniq  # pylint: disable=import-outside-toplevel
+                self.namespace['uniq'] = uniq
+            emit('if {} and not uniq({}):'.format(is_array, var))
+            emit('return False', 1)
+
+        if 'items' in schema:
+            items = schema['items']
+            if isinstance(items, dict):
+                item = self.name('i')
+                emit('if {}:'.format(is_array))
+                emit('for {} in {}:'.format(item, var), 1)
+                self.check(items, item, lines, depth + 2)
+            else:
+                emit('if {}:'.format(is_array))
+                for index, subschema in enumerate(items):
+                    emit('if len({}) > {}:'.format(var, index), 1)
+                    self.check(subschema, '{}[{}]'.format(var, index), lines, depth + 2)
+                emit('pass', 1)
+
+        if 'additionalItems' in schema and not isinstance(schema.get('items', {}), dict):
+            additional = schema['additionalItems']
+            count = len(schema.get('items', []))
+            if isinstance(additional, dict):
+                item = self.name('i')
+                emit('if {}:'.format(is_array))
+                emit('for {} in {}[{}:]:'.format(item, var, count), 1)
+                self.check(additional, item, lines, depth + 2)
+            elif not additional:
+                emit('if {} and len({}) > {}:'.format(is_array, var, count))
+                emit('return False', 1)
+
+        # Numbers
+        if 'minimum' in schema:
+            operator = '<=' if schema.get('exclusiveMinimum', False) else '<'
+            emit('if {} and {} {} {}:'.format(is_number, var, operator, self.constant(schema['minimum'])))
+            emit('return False', 1)
+
+        if 'maximum' in schema:
+            operator = '>=' if schema.get('exclusiveMaximum', False) else '>'
+            emit('if {} and {} {} {}:'.format(is_number, var, operator, self.constant(schema['maximum'])))
+            emit('return False', 1)
+
+        if 'multipleOf' in schema:
+            divisor = self.constant(schema['multipleOf'])
+            emit('if {}:'.format(is_number))
+            if isinstance(schema['multipleOf'], float):
+                quotient = self.name('q')
+                emit('{} = {} / {}'.format(quotient, var, divisor), 1)
+                emit('if int({0}) != {0}:'.format(quotient), 1)
+            else:
+                emit('if {} % {}:'.format(var, divisor), 1)
+            emit('return False', 2)
+
+        # Strings
+        for keyword, operator in (('minLength', '<'), ('maxLength', '>')):
+            if keyword in schema:
+                emit('if {} and len({}) {} {}:'.format(is_string, var, operator, self.constant(schema[keyword])))
+                emit('return False', 1)
+
+        if 'pattern' in schema:
+            emit('if {} and not {}({}):'.format(is_string, self.constant(re.compile(schema['pattern']).search), var))
+            emit('return False', 1)
+
+        # Combinations
+        for subschema in schema.get('allOf', []):
+            self.check(subschema, var, lines, depth)
+
+        if 'anyOf' in schema:
+            functions = [self.function(subschema) for subschema in schema['anyOf']]
+            emit('if not ({}):'.format(' or '.join('{}({})'.format(function, var) for function in functions)))
+            emit('return False', 1)
+
+        if 'oneOf' in schema:
+            functions = [self.function(subschema) for subschema in schema['oneOf']]
+            calls = ', '.join('{}({})'.format(function, var) for function in functions)
+            emit('if [{}].count(True) != 1:'.format(calls))
+            emit('return False', 1)
+
+        if 'not' in schema:
+            emit('if {}({}):'.format(self.function(schema['not']), var))
+            emit('return False', 1)
+
+
+class CompiledValidator():
+    '''
+    Validates records with a compiled schema function. Draft4Validator is only used to report errors and for
+    schemas that cannot be compiled.
+    '''
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.validator = None
+        try:
+            self.function = SchemaCompiler().compile(schema)
+        except (UnsupportedSchema, re.error, SyntaxError, RecursionError, TypeError) as err:
+            log_debug('Schema cannot be compiled, using Draft4Validator: %s', err)
+            self.function = None
+
+    def validate(self, instance):
+        '''
+        Raises the jsonschema ValidationError of invalid instances
+        '''
+        if self.function is not None:
+            try:
+                if self.function(instance):
+                    return
+            except Exception:  # pylint: disable=W0703
+                # Draft4Validator decides, and raises the same error it always did
+                pass
+
+        if self.validator is None:
+            # jsonschema is only imported when a record fails or a schema cannot be compiled
+            from jsonschema.validators import Draft4Validator  # pylint: disable=import-outside-toplevel
+            self.validator = Draft4Validator(self.schema)
+        self.validator.validate(instance)
+
+
+VALIDATORS = {}
+VALIDATORS_LOCK = threading.Lock()
+
+
+def get_validator(schema):
+    '''
+    Returns the validator of a schema. Identical schemas share the same compiled validator.
+    '''
+    key = hashlib.sha1(json.dumps(schema, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+    with VALIDATORS_LOCK:
+        validator = VALIDATORS.get(key)
+        if validator is None:
+            validator = CompiledValidator(schema)
+            VALIDATORS[key] = validator
+    return validator
+
+
+class ValidationSampler():
+    '''
+    Decides which records are validated and counts the validated and skipped records of every stream.
+    Sampled records are chosen from a hash of their line and the seed, so the same input always validates the same
+    records, whichever process handles them.
+    '''
+
+    def __init__(self, mode=VALIDATION_FULL, n=1000, seed=0):
+        self.mode = mode
+        self.n = n
+        self.seed = seed
+        # Validated and skipped records of every stream
+        self.counts = {}
+
+    def should_validate(self, stream, raw_message):
+        counts = self.counts.get(stream)
+        if counts is None:
+            counts = self.counts[stream] = [0, 0]
+
+        mode = self.mode
+        if mode == VALIDATION_FULL:
+            validate = True
+        elif mode == VALIDATION_FIRST_N:
+            validate = counts[0] < self.n
+        elif mode == VALIDATION_SAMPLE:
+            if isinstance(raw_message, str):
+                raw_message = raw_message.encode('utf-8')
+            validate = zlib.crc32(raw_message, self.seed) % self.n == 0
+        else:
+            validate = False
+
+        counts[0 if validate else 1] += 1
+        return validate
@@ -15,11 +15,32 @@
 # This product includes software developed at or by Typo (https://www.typo.ai/).
 
 from io import StringIO
+import email.utils
+import gzip
+import importlib.util
 import json
+import os
+import re
+import tempfile
+import threading
+import time
 import unittest
 from unittest.mock import patch
+from jsonschema.exceptions import ValidationError
+from jsonschema.validators import Draft4Validator
+from benchmarks.mock_server import MockTypoServer
+from benchmarks.tap_generator import generate_messages
 import target_typo.__init__ as init
+from target_typo.auth import TokenManager
+from target_typo.batch import DatasetBuffer, encode_batch, encode_columns, stream_batch
+from target_typo.codec import CODECS, LONG_NUMBER, dumps_bytes, get_codec
+from target_typo.memory import MemoryBudget
+from target_typo.pipeline import AckTracker
+from target_typo.ratelimit import RateLimiter, parse_retry_after
+from target_typo.spool import Spool
 from target_typo.typo import TypoTarget
+from target_typo.utils import KeyCache, build_flatten_plan, flatten, flatten_with_plan
+from target_typo.validation import CompiledValidator, ValidationSampler, get_validator
 
 
 def generate_config():
@@ -35,6 +56,16 @@ def generate_config():
 TYPO_1 = TypoTarget(config=generate_config())
 TYPO_1.token = '123'
 
+
+def generate_batch(rows, dataset='dataset', batch_number=1):
+    batch = DatasetBuffer(dataset, batch_number)
+    for row in rows:
+        batch.append(row)
+    return batch
+
+
+TIMEOUT = (10, 120)
+
 DATASET = 'dataset'
 DATA = {
     'date': '2019-06-23',
@@ -48,7 +79,7 @@ class TestTypo(unittest.TestCase):
         '''
         Test: When API key and API secret are provided, a token property should be returned in the API return.
         '''
-        with patch('target_typo.typo.requests.post') as mocked_post:
+        with patch('target_typo.typo.requests.Session.post') as mocked_post:
             mocked_post.return_value.status_code = 200
             mocked_post.return_value.json.return_value = {'token': 'test'}
 
@@ -62,7 +93,7 @@ class TestTypo(unittest.TestCase):
 
             token = TYPO_1.request_token()
             mocked_post.assert_called_with('https://www.mock.com/token', data=json.dumps(expected_payload),
-                                           headers=expected_headers)
+                                           headers=expected_headers, timeout=TIMEOUT)
             self.assertEqual(token, 'test')
 
     def test_enqueue_to_dataset(self):
@@ -75,11 +106,11 @@ class TestTypo(unittest.TestCase):
             'data': DATA
         }
 
-        result = TYPO_1.enqueue_to_dataset(DATASET, DATA)
+        TYPO_1.enqueue_to_dataset(DATASET, DATA)
 
-        self.assertEqual(result, data_expected)
+        self.assertEqual(TYPO_1.data_out[-1], data_expected)
 
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_import_dataset(self, mock):
         '''
         Test: With all the required information, import_dataset should match expected request call.
@@ -91,16 +122,19 @@ class TestTypo(unittest.TestCase):
             'Content-Type': 'application/json',
             'Authorization': 'Bearer '+TYPO_1.token
         }
-        expected_payload = {
-            'repository': 'test_typo',
-            'dataset': DATASET,
-            'data': DATA
-        }
+        expected_payload = [
+            {
+                'repository': 'test_typo',
+                'dataset': DATASET,
+                'data': DATA
+            }
+        ]
 
         with self.assertLogs():
-            TYPO_1.import_dataset(expected_payload)
+            TYPO_1.import_dataset(generate_batch([DATA]))
 
-        mock.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers)
+        mock.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers,
+                                timeout=TIMEOUT)
 
     @patch('target_typo.typo.TypoTarget.import_dataset')
     def test_with_4_records_post_will_not_be_called(self, mock):
@@ -140,9 +174,10 @@ class TestTypo(unittest.TestCase):
                 i += 1
 
         self.assertTrue(mock.called)
-        self.assertEqual(typo_3.data_out, expected_payload)
+        self.assertEqual(encode_batch('test_typo', mock.call_args[0][0], 'records'), expected_payload)
+        self.assertEqual(typo_3.data_out, [])
 
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_with_6_records(self, mock_post):
         '''
         Test: When there are 6 records in the queue, a POST request is expected with 1 record remaining.
@@ -151,6 +186,7 @@ class TestTypo(unittest.TestCase):
         mock_post.return_value.status_code = 200
 
         typo_4 = TypoTarget(generate_config())
+        typo_4.token = ''
         payload = {
             'repository': 'test_typo',
             'dataset': DATASET,
@@ -180,10 +216,11 @@ class TestTypo(unittest.TestCase):
                 else:
                     typo_4.enqueue_to_dataset(DATASET, data2)
 
-        mock_post.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers)
+        mock_post.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers,
+                                     timeout=TIMEOUT)
         self.assertEqual(typo_4.data_out, [payload_2])
 
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_stdin_ends_post_request_in_queue(self, mock_post):
         '''
         Test: When STDIN ends before POST request thredhold records in queue should be sent.
@@ -240,10 +277,11 @@ class TestTypo(unittest.TestCase):
         with patch('sys.stdout', new=StringIO()), self.assertLogs():
             init.persist_lines(config, records)
 
-        mock_post.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers)
+        mock_post.assert_called_with(expected_url, data=json.dumps(expected_payload), headers=expected_headers,
+                                     timeout=TIMEOUT)
 
     @patch('jsonschema.validators.Draft4Validator.validate')
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_no_schema(self, mock_post, mock_validate):
         '''
         Test: When SCHEMA is not provided, the code should exit with an error.
@@ -278,7 +316,7 @@ class TestTypo(unittest.TestCase):
 
         self.assertTrue(mock_validate)
 
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_record_with_invalid_schema(self, mock_post):
         '''
         Test: When RECORD has invalid SCHEMA, it is expected to output a ValidationError message.
@@ -325,7 +363,7 @@ class TestTypo(unittest.TestCase):
 
         self.assertEqual(raised.exception.code, 1)
 
-    @patch('target_typo.typo.requests.post')
+    @patch('target_typo.typo.requests.Session.post')
     def test_schema_specified_after_record(self, mock_post):
         '''
         Test: When SCHEMA is specified after RECORD Tap process should exit with error.
@@ -367,6 +405,1043 @@ class TestTypo(unittest.TestCase):
 
         self.assertEqual(raised.exception.code, 1)
 
+    @patch('target_typo.typo.requests.Session.post')
+    def test_pipelined_upload_sends_all_batches(self, mock_post):
+        '''
+        Test: With upload_workers configured, every record is sent and the state is emitted after its batches.
+        '''
+
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'token': ''}
+
+        config = generate_config()
+        config['upload_workers'] = 2
+        records = [json.dumps({'type': 'SCHEMA', 'stream': 'mock', 'schema': {}, 'key_properties': []})]
+        for i in range(12):
+            records.append(json.dumps({'type': 'RECORD', 'stream': 'mock', 'record': {'id': i}}))
+        records.append(json.dumps({'type': 'STATE', 'value': {'id': 11}}))
+
+        with patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            init.persist_lines(config, records)
+
+        sent = [json.loads(call[1]['data']) for call in mock_post.call_args_list if call[0][0].endswith('/import')]
+        self.assertEqual(sorted(row['data']['id'] for batch in sent for row in batch), list(range(12)))
+        self.assertEqual(stdout.getvalue(), '{"id": 11}\n')
+
+    def test_state_waits_for_pending_batches(self):
+        '''
+        Test: In pipelined mode a STATE is only emitted once every batch submitted before it is acknowledged.
+        '''
+        tracker = AckTracker()
+        tracker.submit(1)
+        tracker.submit(2)
+
+        with patch('sys.stdout', new=StringIO()) as stdout:
+            tracker.add_state({'position': 2})
+            tracker.ack(2)
+            self.assertEqual(stdout.getvalue(), '')
+            tracker.ack(1)
+
+        self.assertEqual(stdout.getvalue(), '{"position": 2}\n')
+
+    @patch('target_typo.typo.requests.Session.post')
+    def test_trickle_stream_does_not_hold_back_states(self, mock_post):
+        '''
+        Test: A STATE waiting for the open batch of a stream that rarely gets records is emitted before the input
+        ends, once max_state_delay_ms has passed.
+        '''
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'token': 'token'}
+        emitted_before_end = []
+
+        def messages(stdout):
+            yield json.dumps({'type': 'RECORD', 'stream': 'trickle', 'record': {'id': 0}})
+            for position in range(20):
+                yield json.dumps({'type': 'RECORD', 'stream': 'busy', 'record': {'id': position}})
+                if position % 5 == 4:
+                    yield json.dumps({'type': 'STATE', 'value': {'position': position}})
+                    time.sleep(0.01)
+            emitted_before_end.extend(stdout.getvalue().splitlines())
+
+        config = generate_config()
+        config['max_state_delay_ms'] = 5
+        with patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            init.persist_lines(config, messages(stdout))
+
+        self.assertIn('{"position": 14}', emitted_before_end)
+        self.assertEqual(stdout.getvalue().splitlines()[-1], '{"position": 19}')
+
+    def test_states_coalesced_by_record_interval(self):
+        '''
+        Test: Only the latest safe state is emitted once enough records have been acknowledged, and the last one
+        at close.
+        '''
+        tracker = AckTracker(records_interval=20)
+
+        with patch('sys.stdout', new=StringIO()) as stdout:
+            for batch_number in range(1, 6):
+                tracker.submit(batch_number)
+                tracker.ack(batch_number, 10)
+                tracker.add_state({'position': batch_number})
+            self.assertEqual(stdout.getvalue(), '{"position": 1}\n{"position": 3}\n')
+            tracker.check()
+            tracker.close()
+
+        self.assertEqual(stdout.getvalue(), '{"position": 1}\n{"position": 3}\n{"position": 5}\n')
+
+    def test_states_coalesced_by_time_interval(self):
+        '''
+        Test: States are emitted at most once per interval.
+        '''
+        tracker = AckTracker(interval=3600)
+
+        with patch('sys.stdout', new=StringIO()) as stdout:
+            for position in range(10):
+                tracker.add_state({'position': position})
+            tracker.check()
+            self.assertEqual(stdout.getvalue(), '')
+            tracker.last_emit -= 3600
+            tracker.check()
+
+        self.assertEqual(stdout.getvalue(), '{"position": 9}\n')
+
+    def test_session_reuses_connections(self):
+        '''
+        Test: Requests share one pooled session and connection reuse is reported.
+        '''
+        typo = TypoTarget(generate_config())
+        self.assertEqual(typo.connection_stats(), (0, 0))
+
+        pool = typo.session.get_adapter('https://www.mock.com').poolmanager.connection_from_url('https://www.mock.com')
+        pool.num_connections = 1
+        pool.num_requests = 3
+
+        self.assertEqual(typo.connection_stats(), (1, 2))
+
+    @patch('target_typo.typo.requests.Session.post')
+    def test_import_dataset_gzip_compression(self, mock_post):
+        '''
+        Test: With gzip compression, large import bodies are compressed and small ones are sent as they are.
+        '''
+        mock_post.return_value.status_code = 200
+
+        config = generate_config()
+        config['compression'] = 'gzip'
+        config['compression_min_bytes'] = 200
+        typo = TypoTarget(config)
+        payload = [{'repository': 'test_typo', 'dataset': DATASET, 'data': DATA}] * 10
+
+        with self.assertLogs():
+            typo.import_dataset(generate_batch([DATA] * 10))
+
+        kwargs = mock_post.call_args[1]
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(kwargs['data'])), payload)
+
+        with self.assertLogs():
+            typo.import_dataset(generate_batch([DATA]))
+
+        kwargs = mock_post.call_args[1]
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertEqual(kwargs['data'], json.dumps(payload[:1]))
+
+    def test_compression_level_validated_for_compression(self):
+        '''
+        Test: compression_level is checked against the levels of the configured compressor when the config is read.
+        '''
+        config = generate_config()
+        config['compression'] = 'gzip'
+        config['compression_level'] = 9
+        self.assertTrue(init.validate_config(config, 'config.json'))
+
+        config['compression_level'] = 19
+        with self.assertLogs(level='CRITICAL') as logs:
+            self.assertFalse(init.validate_config(config, 'config.json'))
+        self.assertIn('"compression_level" must be lower than or equal to 9', logs.output[0])
+
+        config['compression'] = 'zstd'
+        self.assertTrue(init.validate_config(config, 'config.json'))
+
+        config['compression_level'] = 23
+        with self.assertLogs(level='CRITICAL'):
+            self.assertFalse(init.validate_config(config, 'config.json'))
+
+        config['compression'] = 'gzip'
+        config['compression_level'] = 6.5
+        with self.assertLogs(level='CRITICAL'):
+            self.assertFalse(init.validate_config(config, 'config.json'))
+
+    @patch('target_typo.typo.requests.Session.post')
+    def test_max_batch_bytes_encodes_records_once(self, mock_post):
+        '''
+        Test: Records measured for max_batch_bytes are encoded once, and the request body is built from their encoding.
+        '''
+        mock_post.return_value.status_code = 200
+        config = generate_config()
+        config['send_threshold'] = 10
+        config['max_batch_bytes'] = 100000
+        typo = TypoTarget(config)
+        typo.token = ''
+        records = [{'position': position} for position in range(10)]
+
+        with patch.object(typo.codec, 'dumps', wraps=typo.codec.dumps) as dumps, self.assertLogs():
+            for record in records:
+                typo.enqueue_to_dataset(DATASET, record)
+
+        # One encoding per record, the record overhead of the dataset, then the separator and header of the body
+        self.assertEqual(dumps.call_count, 13)
+        self.assertEqual(json.loads(mock_post.call_args[1]['data']), [
+            {'repository': 'test_typo', 'dataset': DATASET, 'data': record} for record in records
+        ])
+
+    @patch('target_typo.typo.TypoTarget.send_batch')
+    def test_max_batch_bytes_flushes_before_limit(self, mock_send):
+        '''
+        Test: With max_batch_bytes configured, a batch is sent before its serialized size exceeds the limit.
+        '''
+        config = generate_config()
+        config['send_threshold'] = 200
+        record_size = len(json.dumps({'repository': 'test_typo', 'dataset': DATASET, 'data': DATA})) + 2
+        config['max_batch_bytes'] = record_size * 3 + 1
+        typo = TypoTarget(config)
+
+        for _ in range(7):
+            typo.enqueue_to_dataset(DATASET, DATA)
+
+        self.assertEqual([len(call[0][0]) for call in mock_send.call_args_list], [3, 3])
+        self.assertEqual(len(typo.data_out), 1)
+        self.assertEqual(len(json.dumps(encode_batch('test_typo', mock_send.call_args[0][0], 'records'))),
+                         record_size * 3)
+
+    @patch('target_typo.typo.TypoTarget.send_batch')
+    def test_linger_ms_flushes_waiting_records(self, mock_send):
+        '''
+        Test: With linger_ms configured, buffered records are sent once the oldest one has waited long enough.
+        '''
+        config = generate_config()
+        config['linger_ms'] = 1000
+        typo = TypoTarget(config)
+
+        with patch('target_typo.typo.time.monotonic', return_value=100.0):
+            typo.enqueue_to_dataset(DATASET, DATA)
+        with patch('target_typo.typo.time.monotonic', return_value=100.5):
+            typo.check_linger()
+        self.assertFalse(mock_send.called)
+
+        with patch('target_typo.typo.time.monotonic', return_value=101.0):
+            typo.check_linger()
+        self.assertTrue(mock_send.called)
+        self.assertEqual(typo.data_out, [])
+
+    @patch('target_typo.typo.requests.Session.post')
+    def test_datasets_payload_format(self, mock_post):
+        '''
+        Test: Each dataset is buffered on its own and the datasets format sends repository and dataset once.
+        '''
+        mock_post.return_value.status_code = 200
+
+        config = generate_config()
+        config['send_threshold'] = 2
+        config['payload_format'] = 'datasets'
+        typo = TypoTarget(config)
+
+        with self.assertLogs():
+            typo.enqueue_to_dataset('first', {'id': 1})
+            typo.enqueue_to_dataset('second', {'id': 2})
+            typo.enqueue_to_dataset('first', {'id': 3})
+
+        expected_payload = {
+            'repository': 'test_typo',
+            'dataset': 'first',
+            'data': [{'id': 1}, {'id': 3}]
+        }
+        self.assertEqual(json.loads(mock_post.call_args[1]['data']), expected_payload)
+        self.assertEqual(list(typo.buffers), ['second'])
+
+    def test_state_waits_for_open_datasets(self):
+        '''
+        Test: A STATE is held until every dataset buffered before it has been sent.
+        '''
+        typo = TypoTarget(generate_config())
+        typo.token = ''
+
+        with patch('sys.stdout', new=StringIO()) as stdout, \
+                patch('target_typo.typo.TypoTarget.post_request', return_value=(200, {})), self.assertLogs():
+            typo.enqueue_to_dataset('first', DATA)
+            typo.enqueue_to_dataset('second', DATA)
+            typo.set_state({'position': 2})
+            typo.flush_dataset('second')
+            self.assertEqual(stdout.getvalue(), '')
+            typo.flush_dataset('first')
+
+        self.assertEqual(stdout.getvalue(), '{"position": 2}\n')
+
+    def test_adaptive_batching_splits_rejected_batch(self):
+        '''
+        Test: A batch rejected with 413 is split to the reduced batch size, which grows again after fast imports.
+        '''
+        config = generate_config()
+        config['adaptive_batching'] = True
+        config['send_threshold'] = 4
+        config['min_send_threshold'] = 1
+        config['send_threshold_step'] = 2
+        typo = TypoTarget(config)
+        typo.token = ''
+
+        responses = [(413, None), (200, {}), (200, {}), (200, {}), (200, {})]
+        with patch('target_typo.typo.TypoTarget.post_request', side_effect=responses) as mock_post, \
+                patch('sys.stdout', new=StringIO()), self.assertLogs() as logs:
+            for position in range(4):
+                typo.enqueue_to_dataset(DATASET, {'position': position})
+
+        self.assertEqual(mock_post.call_count, 5)
+        self.assertEqual([call[0][2] for call in mock_post.call_args_list[1:]], [
+            [{'repository': 'test_typo', 'dataset': DATASET, 'data': {'position': position}}]
+            for position in range(4)
+        ])
+        # 4 * 0.25 after the rejection, then one step after the first full batch
+        self.assertEqual(typo.sizer.threshold(DATASET), 3)
+        self.assertTrue(any('batch size changed from 4 to 1' in line for line in logs.output))
+
+    @patch('target_typo.typo.TypoTarget.post_request', return_value=(200, {}))
+    def test_spool_resumes_unacknowledged_batches(self, mock_post):
+        '''
+        Test: Records spooled by a stopped run are sent by the next run before its input, followed by the last state.
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            config = generate_config()
+            config['spool_dir'] = directory
+
+            stopped = TypoTarget(config)
+            stopped.token = ''
+            with patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+                for position in range(7):
+                    stopped.enqueue_to_dataset(DATASET, {'position': position})
+                stopped.set_state({'position': 6})
+            # The process stops without sending its open buffer
+            stopped.buffers[DATASET].file.close()
+            # The first 5 records were sent, the state waits for the 2 others
+            self.assertEqual(stdout.getvalue(), '')
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            resumed = TypoTarget(config)
+            resumed.token = ''
+            with patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+                resumed.resume()
+                resumed.flush()
+
+            # Spooled records are sent as they were encoded
+            self.assertEqual(json.loads(mock_post.call_args[0][2]), [
+                {'repository': 'test_typo', 'dataset': DATASET, 'data': {'position': 5}},
+                {'repository': 'test_typo', 'dataset': DATASET, 'data': {'position': 6}}
+            ])
+            self.assertEqual(stdout.getvalue(), '{"position": 6}\n')
+            self.assertEqual(os.listdir(directory), ['state.json'])
+
+    @patch('target_typo.typo.TypoTarget.post_request', return_value=(200, {}))
+    def test_spool_does_not_write_every_state(self, mock_post):
+        '''
+        Test: States received in a burst are written to the spool directory once, not once per STATE message.
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            config = generate_config()
+            config['spool_dir'] = directory
+            typo = TypoTarget(config)
+            typo.token = ''
+
+            with patch('target_typo.spool.Spool.write_state') as write_state, patch('sys.stdout', new=StringIO()):
+                typo.enqueue_to_dataset(DATASET, {'position': 0})
+                for position in range(100):
+                    typo.set_state({'position': position})
+            typo.buffers[DATASET].file.close()
+
+            self.assertEqual(write_state.call_count, 1)
+
+    def test_budget_keeps_batches_large(self):
+        '''
+        Test: While batches being sent hold the budget, new records do not flush nearly empty buffers. Buffers are
+        only sent for the budget once they hold half of it between them.
+        '''
+        config = generate_config()
+        config['send_threshold'] = 1000
+        config['max_buffered_bytes'] = 20000
+        typo = TypoTarget(config)
+        # Records go over the budget instead of waiting for an upload thread
+        typo.wait_for_budget = False
+        in_flight = []
+        sent = []
+
+        def send(batch):
+            # Two batches are being sent at a time, the oldest is acknowledged when a third one starts
+            sent.append(batch.reserved)
+            in_flight.append(batch)
+            if len(in_flight) > 2:
+                typo.budget.release(in_flight.pop(0).reserved)
+
+        with patch.object(typo, 'send_batch', side_effect=send):
+            for position in range(4000):
+                typo.enqueue_to_dataset('stream_{}'.format(position % 2), {'position': position, 'text': 'x' * 20})
+
+        # The largest of the two buffers holding half of the budget is at least a quarter of it
+        self.assertGreaterEqual(min(sent) * 4, config['max_buffered_bytes'])
+        self.assertLess(len(sent), 80)
+
+    def test_spooled_batch_streamed_from_file(self):
+        '''
+        Test: The body of a spooled batch is read from its segment file while it is streamed, every time it is sent.
+        '''
+        codec = get_codec('json')
+        records = [{'position': position} for position in range(5)]
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(directory, codec)
+            segment = spool.open_segment(DATASET, 1)
+            for record in records:
+                segment.append(record)
+            spool.seal(segment)
+
+            self.assertNotIsInstance(segment.rows, list)
+            body = stream_batch('test_typo', segment, 'records', codec)
+            expected = dumps_bytes(codec, encode_batch('test_typo', segment, 'records'))
+            self.assertEqual(b''.join(body), expected)
+            self.assertEqual(b''.join(body), expected)
+            self.assertEqual(len(body), len(expected))
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def test_token_refreshed_before_expiry(self):
+        '''
+        Test: A token is requested again once its lifetime minus the refresh margin has passed.
+        '''
+        tokens = iter(['first', 'second'])
+        manager = TokenManager(lambda: (next(tokens), None), 3600, 300)
+
+        with patch('target_typo.auth.time.monotonic', return_value=1000.0):
+            self.assertEqual(manager.get(), 'first')
+        with patch('target_typo.auth.time.monotonic', return_value=1000.0 + 3299):
+            self.assertEqual(manager.get(), 'first')
+        with patch('target_typo.auth.time.monotonic', return_value=1000.0 + 3300):
+            self.assertEqual(manager.get(), 'second')
+
+    def test_concurrent_invalidations_request_one_token(self):
+        '''
+        Test: Threads rejected with the same token only trigger one token request.
+        '''
+        requested = []
+
+        def request_token():
+            time.sleep(0.05)
+            requested.append(1)
+            return 'token-{}'.format(len(requested)), None
+
+        manager = TokenManager(request_token, 3600, 300)
+        manager.set_token('expired')
+
+        def send():
+            manager.invalidate('expired')
+            self.assertEqual(manager.get(), 'token-1')
+
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(requested), 1)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_requests_and_bytes_limited(self):
+        '''
+        Test: Requests wait for both the request and the bytes token buckets, after a burst of one second.
+        '''
+        limiter = RateLimiter(requests_per_second=20)
+        started = time.monotonic()
+        for _ in range(30):
+            limiter.acquire(100)
+        self.assertGreaterEqual(time.monotonic() - started, 0.45)
+
+        limiter = RateLimiter(bytes_per_second=1000)
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.acquire(750)
+        self.assertGreaterEqual(time.monotonic() - started, 1.2)
+
+    def test_parse_retry_after(self):
+        '''
+        Test: Retry-After is read in seconds or as an HTTP date.
+        '''
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        later = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(later), 30, delta=2)
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_codecs_match_json_module(self):
+        '''
+        Test: Every installed codec decodes and encodes non-ASCII text, large integers and NaN like the json module.
+        '''
+        lines = [
+            '{"text": "caf\\u00e9 \u65e5\u672c", "emoji": "\\ud83d\\ude00"}',
+            '{"id": 123456789012345678901234567890, "negative": -9223372036854775809}',
+            '{"nan": NaN, "inf": Infinity, "ninf": -Infinity, "big": 1e400, "list": [NaN, 1.5]}',
+            '{"nested": {"a": [1, 2.25, null, true, "x/y"]}}'
+        ]
+
+        for name in CODECS[1:]:
+            if name != 'json' and importlib.util.find_spec(name) is None:
+                continue
+            codec = get_codec(name)
+            for line in lines:
+                decoded = codec.loads(line)
+                self.assertEqual(repr(decoded), repr(json.loads(line)), name)
+
+                encoded = codec.dumps(decoded)
+                if isinstance(encoded, bytes):
+                    encoded = encoded.decode('utf-8')
+                self.assertEqual(repr(json.loads(encoded)), repr(json.loads(line)), name)
+                self.assertEqual(set(re.findall('NaN|-?Infinity', encoded)),
+                                 set(re.findall('NaN|-?Infinity', json.dumps(json.loads(line)))), name)
+
+    def test_auto_codec_encodes_like_json_module(self):
+        '''
+        Test: The default codec writes the same bytes as the json module, and only long number tokens take the
+        json module path.
+        '''
+        record = {'text': 'caf\u00e9 \u65e5\u672c', 'id': '12345678901234567890', 'values': [1, 2.5, None]}
+        codec = get_codec()
+        self.assertEqual(codec.dumps(codec.loads(json.dumps(record))), json.dumps(record))
+
+        self.assertIsNone(LONG_NUMBER.search('{"id": "12345678901234567890", "ts": "x12345678901234567890"}'))
+        self.assertIsNotNone(LONG_NUMBER.search('{"id": 12345678901234567890}'))
+        self.assertIsNotNone(LONG_NUMBER.search('{"ids": [1,-12345678901234567890]}'))
+
+    def test_invalid_line_raises_json_error(self):
+        '''
+        Test: Every codec raises the json module decode error on invalid lines.
+        '''
+        for name in CODECS:
+            if name not in ('auto', 'json') and importlib.util.find_spec(name) is None:
+                continue
+            with self.assertRaises(json.decoder.JSONDecodeError):
+                get_codec(name).loads('{"type": ')
+
+    def test_streamed_body_matches_encoded_payload(self):
+        '''
+        Test: The chunks of a streamed body join to the encoding of the payload by every codec, in both formats.
+        '''
+        rows = [{'id': index, 'text': 'value {} ü'.format(index), 'nested': {'a': [1, None]}} for index in range(3)]
+        for name in CODECS[1:]:
+            if name != 'json' and importlib.util.find_spec(name) is None:
+                continue
+            codec = get_codec(name)
+            for payload_format in ('records', 'datasets'):
+                for encoded in (False, True):
+                    batch = DatasetBuffer('dataset', 1, codec if encoded else None)
+                    for row in rows:
+                        batch.append(dumps_bytes(codec, row) if encoded else row)
+                    body = stream_batch('repository', batch, payload_format, codec)
+                    expected = dumps_bytes(codec, encode_batch('repository', batch, payload_format))
+                    self.assertEqual(b''.join(body), expected)
+                    self.assertEqual(len(body), len(expected))
+
+
+class TestValidation(unittest.TestCase):
+
+    SCHEMA = {
+        'type': 'object',
+        'properties': {
+            'id': {'type': 'integer', 'minimum': 1},
+            'name': {'type': ['string', 'null'], 'maxLength': 5, 'pattern': '^[a-z]'},
+            'price': {'type': 'number', 'multipleOf': 0.5, 'exclusiveMaximum': True, 'maximum': 100},
+            'tags': {'type': 'array', 'items': {'enum': ['a', 'b']}, 'uniqueItems': True},
+            'address': {
+                'type': 'object',
+                'properties': {'zip': {'anyOf': [{'type': 'string'}, {'type': 'null'}]}},
+                'required': ['zip'],
+                'additionalProperties': False
+            },
+            'kind': {'oneOf': [{'type': 'integer'}, {'type': 'number', 'minimum': 10}], 'not': {'enum': [3]}}
+        },
+        'required': ['id']
+    }
+
+    def test_compiled_validator_matches_draft4(self):
+        '''
+        Test: The compiled validator accepts and rejects the same records as Draft4Validator.
+        '''
+        records = [
+            {'id': 1}, {'id': 0}, {'id': True}, {'id': 1.0}, {}, [], None,
+            {'id': 1, 'name': None}, {'id': 1, 'name': 'abcdef'}, {'id': 1, 'name': 'Abc'},
+            {'id': 1, 'price': 1.5}, {'id': 1, 'price': 1.25}, {'id': 1, 'price': 100}, {'id': 1, 'price': '1'},
+            {'id': 1, 'tags': ['a', 'b']}, {'id': 1, 'tags': ['a', 'a']}, {'id': 1, 'tags': ['c']},
+            {'id': 1, 'address': {'zip': None}}, {'id': 1, 'address': {}}, {'id': 1, 'address': {'zip': 1}},
+            {'id': 1, 'address': {'zip': 'a', 'city': 'b'}}, {'id': 1, 'address': 'a'},
+            {'id': 1, 'kind': 2}, {'id': 1, 'kind': 3}, {'id': 1, 'kind': 12}, {'id': 1, 'kind': 10.5},
+            {'id': 1, 'kind': 1.5}
+        ]
+        validator = CompiledValidator(self.SCHEMA)
+        reference = Draft4Validator(self.SCHEMA)
+
+        self.assertIsNotNone(validator.function)
+        for record in records:
+            self.assertEqual(validator.function(record), reference.is_valid(record), record)
+
+    def test_invalid_record_raises_validation_error(self):
+        '''
+        Test: Invalid records raise the same ValidationError as Draft4Validator.
+        '''
+        with self.assertRaises(ValidationError) as raised:
+            CompiledValidator(self.SCHEMA).validate({'id': 'one'})
+
+        self.assertEqual(raised.exception.message, "'one' is not of type 'integer'")
+
+    def test_identical_schemas_share_validator(self):
+        '''
+        Test: Identical schemas reuse the same compiled validator, unsupported schemas use Draft4Validator.
+        '''
+        self.assertIs(get_validator(dict(self.SCHEMA)), get_validator(json.loads(json.dumps(self.SCHEMA))))
+
+        with self.assertLogs(level='DEBUG'):
+            validator = get_validator({'definitions': {'a': {'type': 'string'}}, '$ref': '#/definitions/a'})
+        self.assertIsNone(validator.function)
+        self.assertRaises(ValidationError, validator.validate, 1)
+
+    def test_validation_sampler_modes(self):
+        '''
+        Test: first_n validates the first records of each stream and sample the same records on every run.
+        '''
+        lines = ['{{"type": "RECORD", "stream": "s", "record": {{"id": {}}}}}'.format(index) for index in range(1000)]
+
+        first_n = ValidationSampler('first_n', 3)
+        self.assertEqual([first_n.should_validate(stream, line) for stream in 'ab' for line in lines[:5]],
+                         [True] * 3 + [False] * 2 + [True] * 3 + [False] * 2)
+        self.assertEqual(first_n.counts, {'a': [3, 2], 'b': [3, 2]})
+
+        sampler = ValidationSampler('sample', 10, 7)
+        sampled = [line for line in lines if sampler.should_validate('s', line)]
+        sampler = ValidationSampler('sample', 10, 7)
+        self.assertEqual(sampled, [line for line in lines if sampler.should_validate('s', line)])
+        self.assertTrue(50 < len(sampled) < 150)
+
+        off = ValidationSampler('off')
+        self.assertFalse(off.should_validate('s', lines[0]))
+        self.assertEqual(off.counts, {'s': [0, 1]})
+
+    def test_persist_lines_validation_first_n(self):
+        '''
+        Test: With first_n, records after the first ones are sent without validation and the counts are logged.
+        '''
+        messages = [
+            json.dumps({'type': 'SCHEMA', 'stream': DATASET, 'key_properties': [],
+                        'schema': {'type': 'object', 'properties': {'id': {'type': 'integer'}}}})
+        ] + [json.dumps({'type': 'RECORD', 'stream': DATASET, 'record': {'id': index}}) for index in range(4)]
+        messages.append(json.dumps({'type': 'RECORD', 'stream': DATASET, 'record': {'id': 'text'}}))
+
+        config = generate_config()
+        config['validation_mode'] = 'first_n'
+        config['validation_n'] = 2
+        with patch('target_typo.typo.requests.Session.post') as mock_post, self.assertLogs() as logs:
+            mock_post.return_value.status_code = 200
+            mock_post.return_value.json.return_value = {'token': 'token'}
+            init.persist_lines(config, messages)
+
+        self.assertTrue(any('Stream {}: 2 records validated, 3 skipped.'.format(DATASET) in line
+                            for line in logs.output))
+
+
+class TestFlatten(unittest.TestCase):
+
+    def test_flatten_with_plan_matches_flatten(self):
+        '''
+        Test: Flattening with a schema plan gives the same keys, values and order as flatten, including keys
+        missing from the schema.
+        '''
+        schema = {
+            'type': 'object',
+            'properties': {
+                'id': {'type': 'integer'},
+                'owner': {
+                    'anyOf': [
+                        {'type': 'null'},
+                        {'type': 'object', 'properties': {'name': {'type': 'string'}, 'tags': {'type': 'array'}}}
+                    ]
+                }
+            }
+        }
+        record = {
+            'id': 1,
+            'owner': {'name': 'a', 'tags': ['x', 'y'], 'address': {'city': 'b', 'zip': None}},
+            'extra': {'nested': {'value': 2.5}},
+            'owner__name': 'duplicate',
+            'empty': {}
+        }
+        plan = build_flatten_plan(schema)
+
+        self.assertEqual(plan['owner'][1]['tags'], ('owner__tags', None))
+        self.assertEqual(list(flatten_with_plan(record, plan).items()), list(flatten(record).items()))
+
+    def test_key_cache_shares_keys_with_lru_eviction(self):
+        '''
+        Test: Cached keys are shared by the flattened rows, and the least recently used ones are evicted.
+        '''
+        cache = KeyCache(maxsize=4)
+        rows = [flatten({'id': index, 'a': {'b': index, 'c': index}}, cache=cache) for index in range(3)]
+
+        self.assertEqual(rows[2], flatten({'id': 2, 'a': {'b': 2, 'c': 2}}))
+        self.assertIs(list(rows[0])[1], list(rows[2])[1])
+        self.assertEqual((cache.hits, cache.misses), (8, 4))
+
+        flatten_with_plan({'x': {'y': 1}}, {}, cache=cache)
+        self.assertEqual(list(cache.keys), [('a', 'b'), ('a', 'c'), ('', 'x'), ('x', 'y')])
+
+
+class TestMockServer(unittest.TestCase):
+
+    def test_persist_lines_against_mock_server(self):
+        '''
+        Test: Every record of the synthetic tap reaches the mock Typo API and the last state is emitted.
+        '''
+        messages = list(generate_messages(streams=2, records=250, width=6, depth=2, state_every=100))
+
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 50
+            init.persist_lines(config, messages)
+
+        self.assertEqual(len(server.records), 250)
+        self.assertEqual(sorted(row['int_0'] for _, row in server.records), list(range(250)))
+        self.assertEqual(stdout.getvalue().splitlines()[-1], '{"bookmark": 199}')
+
+    def test_import_retried_with_new_token_after_401(self):
+        '''
+        Test: A batch rejected with 401 is sent again with a new token.
+        '''
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()), self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            typo = TypoTarget(config)
+            typo.token = 'expired'
+            for position in range(5):
+                typo.enqueue_to_dataset(DATASET, {'position': position})
+
+            self.assertEqual(typo.token, server.token)
+            self.assertEqual(len(server.records), 5)
+
+    def test_rejected_records_written_to_dead_letter_file(self):
+        '''
+        Test: Batches rejected with 400 are split until the rejected records are isolated in the dead letter file.
+        '''
+        def reject(row):
+            return 'Invalid position' if row['position'] in (3, 17) else None
+
+        with tempfile.TemporaryDirectory() as directory, MockTypoServer(reject=reject) as server, \
+                patch('sys.stdout', new=StringIO()), self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 10
+            config['dead_letter_file'] = os.path.join(directory, 'rejected.jsonl')
+            typo = TypoTarget(config)
+            for position in range(20):
+                typo.enqueue_to_dataset(DATASET, {'position': position})
+            typo.flush()
+
+            with open(config['dead_letter_file']) as dead_letters:
+                rejected = [json.loads(line) for line in dead_letters]
+
+        self.assertEqual(sorted(row['position'] for _, row in server.records),
+                         [position for position in range(20) if position not in (3, 17)])
+        self.assertEqual(rejected, [
+            {'dataset': DATASET, 'record': {'position': position}, 'status': 400, 'error': 'Invalid position'}
+            for position in (3, 17)
+        ])
+
+    def test_batch_rejected_entirely_stops_target(self):
+        '''
+        Test: When every record of a batch is rejected, the target stops instead of emitting the state after it.
+        '''
+        with tempfile.TemporaryDirectory() as directory, MockTypoServer(reject=lambda row: 'Read only') as server, \
+                patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 4
+            config['dead_letter_file'] = os.path.join(directory, 'rejected.jsonl')
+            typo = TypoTarget(config)
+            typo.set_state({'position': 0})
+            with self.assertRaises(SystemExit):
+                for position in range(4):
+                    typo.enqueue_to_dataset(DATASET, {'position': position})
+            typo.dead_letters.close()
+
+        self.assertEqual(server.records, [])
+        self.assertEqual(stdout.getvalue(), '{"position": 0}\n')
+
+    @patch('target_typo.typo.TypoTarget.post_request', return_value=(403, {'message': 'Forbidden'}))
+    def test_forbidden_batch_is_not_split(self, mock_post):
+        '''
+        Test: Client errors that do not point at the records, such as 403, stop the target without splitting the batch.
+        '''
+        with tempfile.TemporaryDirectory() as directory, patch('sys.stdout', new=StringIO()), self.assertLogs():
+            config = generate_config()
+            config['dead_letter_file'] = os.path.join(directory, 'rejected.jsonl')
+            typo = TypoTarget(config)
+            typo.token = ''
+            with self.assertRaises(SystemExit):
+                for position in range(5):
+                    typo.enqueue_to_dataset(DATASET, {'position': position})
+
+            self.assertEqual(mock_post.call_count, 1)
+            self.assertFalse(os.path.exists(config['dead_letter_file']))
+
+    def test_streamed_body_with_gzip(self):
+        '''
+        Test: Records encoded when they are buffered reach Typo through a streamed and compressed body.
+        '''
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()), self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['stream_body'] = True
+            config['compression'] = 'gzip'
+            config['compression_min_bytes'] = 0
+            typo = TypoTarget(config)
+            for position in range(12):
+                typo.enqueue_to_dataset(DATASET, {'position': position, 'name': 'ünïcode'})
+            typo.flush()
+
+        self.assertEqual(server.records, [(DATASET, {'position': position, 'name': 'ünïcode'})
+                                          for position in range(12)])
+
+    def test_buffered_bytes_budget(self):
+        '''
+        Test: Buffered, queued and in-flight batches stay within max_buffered_bytes, in synchronous and pipelined mode.
+        '''
+        for upload_workers in (0, 2):
+            with MockTypoServer(latency_ms=5) as server, patch('sys.stdout', new=StringIO()), self.assertLogs():
+                config = generate_config()
+                config['cluster_api_endpoint'] = server.url
+                config['send_threshold'] = 50
+                config['upload_workers'] = upload_workers
+                config['max_buffered_bytes'] = 2000
+                typo = TypoTarget(config)
+                for position in range(100):
+                    typo.enqueue_to_dataset(DATASET if position % 2 else 'other', {'position': position, 'x': 'y' * 20})
+                typo.flush()
+
+            self.assertEqual(sorted(row['position'] for _, row in server.records), list(range(100)))
+            self.assertEqual(typo.budget.used, 0)
+            self.assertLessEqual(typo.budget.peak, 2000)
+            # Without the budget, both datasets would be sent in one batch of 50 records
+            self.assertGreater(len(server.requests), 2)
+
+    def test_memory_budget_waits_for_release(self):
+        '''
+        Test: A reservation over the budget waits for a release, and a record larger than the budget is allowed alone.
+        '''
+        budget = MemoryBudget(100)
+        self.assertTrue(budget.try_acquire(500))
+        self.assertFalse(budget.try_acquire(1))
+        budget.release(500)
+
+        budget.acquire(60)
+        timer = threading.Timer(0.05, budget.release, (60,))
+        timer.start()
+        with self.assertLogs(level='DEBUG'):
+            budget.acquire(60)
+        timer.join()
+
+        self.assertEqual(budget.gauges()['backpressure_waits'], 1)
+        self.assertEqual(budget.peak, 500)
+
+    def test_deduplicate_by_key_properties(self):
+        '''
+        Test: Only the last version of each key is sent within a batch, and the replaced rows are counted.
+        '''
+        messages = [json.dumps({'type': 'SCHEMA', 'stream': DATASET, 'key_properties': ['id'],
+                                'schema': {'type': 'object', 'properties': {'id': {'type': ['integer', 'null']},
+                                                                            'version': {'type': 'integer'}}}})]
+        messages += [json.dumps({'type': 'RECORD', 'stream': DATASET, 'record': {'id': index % 3, 'version': index}})
+                     for index in range(7)]
+        messages += [json.dumps({'type': 'RECORD', 'stream': DATASET, 'record': {'id': None, 'version': version}})
+                     for version in (7, 8)]
+
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()), self.assertLogs() as logs:
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 5
+            config['deduplicate'] = True
+            init.persist_lines(config, messages)
+
+        self.assertEqual([row for _, row in server.records], [
+            {'id': 0, 'version': 6}, {'id': 1, 'version': 4}, {'id': 2, 'version': 5},
+            {'id': None, 'version': 7}, {'id': None, 'version': 8}
+        ])
+        self.assertTrue(any('Stream {}: 4 rows replaced'.format(DATASET) in line for line in logs.output))
+
+    def test_columns_payload_format(self):
+        '''
+        Test: Batches in the columns format are decoded by Typo into the original rows, with repeated strings
+        dictionary encoded.
+        '''
+        rows = [{'id': index, 'status': 'active' if index % 3 else 'closed', 'note': None} for index in range(9)]
+        rows[4] = {'id': 4, 'extra': 'only here'}
+
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()), self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['payload_format'] = 'columns'
+            typo = TypoTarget(config)
+            for row in rows:
+                typo.enqueue_to_dataset(DATASET, row)
+            typo.flush()
+
+        self.assertEqual(server.records, [(DATASET, row) for row in rows])
+        columns = encode_columns(rows)
+        self.assertEqual([column['name'] for column in columns], ['id', 'status', 'note', 'extra'])
+        self.assertEqual(columns[1]['dictionary'], ['closed', 'active'])
+        self.assertEqual(columns[1]['missing'], [4])
+        self.assertNotIn('dictionary', columns[3])
+
+    def test_throttled_imports_wait_for_retry_after(self):
+        '''
+        Test: Imports answered with 429 are sent again after Retry-After, with a lower request rate.
+        '''
+        with MockTypoServer(throttle=2, retry_after=0) as server, patch('sys.stdout', new=StringIO()), \
+                self.assertLogs() as logs:
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['max_requests_per_second'] = 1000
+            typo = TypoTarget(config)
+            typo.token = server.token
+            for position in range(10):
+                typo.enqueue_to_dataset(DATASET, {'position': position})
+
+        self.assertEqual(len(server.records), 10)
+        self.assertTrue(any('Typo returned status code 429' in line for line in logs.output))
+        # Halved twice, then grown back by the 2 accepted requests
+        self.assertAlmostEqual(typo.limiter.request_rate, 250 * 1.05 * 1.05)
+
+    def test_persist_lines_metrics(self):
+        '''
+        Test: Every stage is timed, and per stream counters are logged as Singer metrics and written to the summary.
+        '''
+        messages = list(generate_messages(streams=2, records=100, width=6, depth=1, state_every=50))
+
+        with tempfile.TemporaryDirectory() as directory, MockTypoServer() as server, \
+                patch('sys.stdout', new=StringIO()), self.assertLogs() as logs:
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 25
+            config['metrics_interval_s'] = 3600
+            config['metrics_file'] = os.path.join(directory, 'metrics.json')
+            init.persist_lines(config, messages)
+
+            with open(config['metrics_file']) as summary_input:
+                summary = json.load(summary_input)
+
+        self.assertEqual(summary['stages']['read']['count'], len(messages))
+        self.assertEqual(summary['stages']['validate']['count'], 100)
+        # Token request and 4 imports
+        self.assertEqual(summary['stages']['http']['count'], 5)
+        self.assertEqual(summary['stages']['state']['count'], 2)
+        self.assertEqual(summary['streams']['stream_0']['records'], 50)
+        self.assertEqual(summary['streams']['stream_0']['batches'], 2)
+        self.assertEqual(sum(summary['streams']['stream_1']['latency_ms'].values()), 2)
+        self.assertTrue(any('METRIC: {"type": "counter", "metric": "record_count", "value": 50, '
+                            '"tags": {"endpoint": "stream_0"}}' in line for line in logs.output))
+
+    def test_persist_lines_with_worker_processes(self):
+        '''
+        Test: Records processed by worker processes are sent in input order, with the schemas seen so far.
+        '''
+        messages = list(generate_messages(streams=2, records=250, width=6, depth=2, state_every=100))
+        # Schema of a new stream sent in the middle of the input, in a later chunk
+        messages.insert(150, json.dumps({'type': 'SCHEMA', 'stream': 'late', 'key_properties': [],
+                                         'schema': {'type': 'object', 'properties': {'a': {
+                                             'type': 'object', 'properties': {'b': {'type': 'integer'}}}}}}))
+        messages.insert(151, json.dumps({'type': 'RECORD', 'stream': 'late', 'record': {'a': {'b': 1}}}))
+
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 50
+            config['workers'] = 2
+            config['worker_chunk_size'] = 20
+            init.persist_lines(config, messages)
+
+        rows = [row['int_0'] for dataset, row in server.records if dataset == 'stream_0']
+        self.assertEqual(rows, list(range(0, 250, 2)))
+        self.assertIn(('late', {'a__b': 1}), server.records)
+        self.assertEqual(stdout.getvalue().splitlines()[-1], '{"bookmark": 199}')
+
+    def test_persist_lines_with_async_engine(self):
+        '''
+        Test: The async engine sends every batch with concurrent requests and emits the last state once acknowledged.
+        '''
+        messages = list(generate_messages(streams=2, records=250, width=6, depth=2, state_every=100))
+
+        with MockTypoServer(latency_ms=20) as server, patch('sys.stdout', new=StringIO()) as stdout, self.assertLogs():
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 10
+            config['engine'] = 'async'
+            config['async_concurrency'] = 4
+            init.persist_lines(config, messages)
+
+        self.assertEqual(sorted(row['int_0'] for _, row in server.records), list(range(250)))
+        self.assertEqual(stdout.getvalue().splitlines(), ['{"bookmark": 99}', '{"bookmark": 199}'])
+
+    def test_async_engine_stops_on_upload_error_with_budget(self):
+        '''
+        Test: With a buffered bytes budget, an upload failure in the async engine stops the target instead of
+        leaving the input reader waiting for the budget.
+        '''
+        messages = list(generate_messages(streams=2, records=500, width=6, depth=1))
+        outcome = []
+
+        def run():
+            try:
+                init.persist_lines(config, messages)
+            except SystemExit as err:
+                outcome.append(err)
+
+        with MockTypoServer(reject=lambda row: 'Rejected') as server, patch('sys.stdout', new=StringIO()), \
+                self.assertLogs() as logs:
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['send_threshold'] = 20
+            config['engine'] = 'async'
+            config['async_concurrency'] = 2
+            config['max_buffered_bytes'] = 3000
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(outcome), 1)
+        self.assertTrue(any('400' in line for line in logs.output))
+
+    def test_worker_processes_stop_on_invalid_record(self):
+        '''
+        Test: A record failing validation in a worker process stops the target.
+        '''
+        messages = list(generate_messages(streams=1, records=100, width=4))
+        messages.append(json.dumps({'type': 'RECORD', 'stream': 'stream_0', 'record': {'int_0': 'text'}}))
+
+        with MockTypoServer() as server, patch('sys.stdout', new=StringIO()), self.assertLogs() as logs, \
+                self.assertRaises(SystemExit):
+            config = generate_config()
+            config['cluster_api_endpoint'] = server.url
+            config['workers'] = 2
+            config['worker_chunk_size'] = 30
+            init.persist_lines(config, messages)
+
+        self.assertTrue(any('is not of type' in line for line in logs.output))
+
 
 if __name__ == '__main__':
     unittest.main()